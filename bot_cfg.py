@@ -16,13 +16,80 @@
 # You should have received a copy of the GNU General Public License
 # along with bot_cfg.y. If not, see <http://www.gnu.org/licenses/>.
 
+# Changes to this file, language_watchlist.py and the blocklist files are picked up while
+# the bot runs, checked every reload_interval seconds (0 to disable). Connection, channel,
+# file, port and sound effect command settings still need a restart.
+reload_interval = 2
+
 # Twitch IRC variables
 host_server = "irc.twitch.tv"
 host_port = 6667
 bot_admin = "" # the administrator of the bot
 bot_handle = "" # must be lowercase
 bot_password = "oauth:" # visit http://twitchapps.com/tmi/ to obtain
-channel = "#" # first character is a hashtag
+channels = [ "#" ] # channels to join; first character of each is a hashtag
+
+# Logging
+# Level of detail logged: DEBUG, INFO, WARNING or ERROR
+log_level = "INFO"
+# Levels for individual subsystems (irc, sql, moderation, commands, chat, ...),
+# such as { "chat": "WARNING" } to stop logging chat messages
+log_levels = {}
+# File to log to as well as the screen; empty for none. Rotated once it reaches
+# log_file_size bytes, keeping log_file_count old files.
+log_file = ""
+log_file_size = 10485760
+log_file_count = 5
+
+# Statistics
+# Port of the local stats endpoint (http://127.0.0.1:port/metrics, Prometheus text format); 0 to disable.
+# Supervisor workers use this port plus their worker number.
+metrics_port = 0
+
+# Database
+# File to keep viewer data in between runs. ":memory:" discards everything when the bot exits.
+db_file = "foundationalbot.db"
+# Changes are committed to disk in batches, from a background thread: after this many
+# seconds or this many changed rows, whichever comes first. A crash loses at most one batch.
+db_commit_interval = 5
+db_commit_writes = 1000
+# SQLite synchronous level. NORMAL only syncs to disk on checkpoints, and may lose
+# the last batches on power loss. FULL syncs every batch, which takes longer.
+db_synchronous = "NORMAL"
+# Number of viewers kept in memory in front of the database
+db_cache_size = 10000
+# Number of changed viewers collected in the cache before they are handed to the next batch
+db_flush_size = 100
+
+# Currency
+# Every currency_interval seconds, each viewer in chat earns currency_amount (0 to disable)
+currency_interval = 60
+currency_amount = 1
+
+# Background work
+# Threads for blocking work such as starting the sound effect player and committing the database
+pool_threads = 4
+# Processes for long computations such as rebuilding large blocklists; 0 runs them in the threads
+pool_processes = 0
+# Jobs each pool takes at once; further jobs wait their turn
+pool_queue_size = 32
+
+# Supervisor (fb_supervisor.py) to spread many channels across processes
+# Number of worker processes; each has its own connection and database file, and
+# an equal share of the message and join rate limits
+supervisor_workers = 4
+# File listing channels one per line, checked for changes while running. Empty to only use channels.
+supervisor_channels_file = ""
+
+# Chat Commands
+# Seconds before a command may be used again in a channel, and again by the same viewer.
+# Moderators, the broadcaster and the bot administrator are not held to cooldowns.
+command_cooldown = 5
+command_user_cooldown = 30
+# Cooldowns of individual commands as command:(channel seconds, viewer seconds), such as { "!time": (30, 60) }
+command_cooldowns = {}
+# The same reply is sent to a channel at most once in this many seconds
+command_reply_dedup = 30
 
 # Game Service Handles - Leave empty to disable corresponding !command
 xbox_handle = ""
@@ -32,13 +99,22 @@ steam_handle = ""
 
 # Special Effects
 # Sound effects are played by VLC, so this bot should run on the streaming machine to make
-# use of this feature (or wait for VLC remote control support, which may never come).
+# use of this feature. One VLC is started with the bot and controlled through its remote
+# control (RC) interface on a local port.
 
 # Path to the VLC executable
 vlc_bin = "C:\Program Files\VideoLAN\VLC\vlc.exe"
+# Local port VLC listens on for RC commands
+sfx_player_port = 4212
+# Command line of another player to use instead of VLC; it must accept VLC's RC commands
+# (add, clear, stop, is_playing, shutdown) on sfx_player_port. Empty to use VLC.
+sfx_player_command = []
 
-# Invoking multiple sound effects will make them play concurrently. There is no queue or
-# blocking for these commands. Stopping playback involves killing VLC via task manager.
+# Sound effects play one after another. At most sfx_queue_size effects wait to play, and
+# the same effect may only be queued once per sfx_cooldown seconds. Moderators can skip
+# the playing effect with "!sfx skip" or clear the queue with "!sfx stop".
+sfx_queue_size = 5
+sfx_cooldown = 10
 
 # Sound Effect 1 Settings
 # The string to listen to for the first sound effect
@@ -69,5 +145,32 @@ strikes_until_ban = 5
 # Length of silence timeout for repeated strikes in seconds (default 600 seconds = 10 minutes)
 strikes_timeout_duration = 600
 
+# Each message is checked against the rules below, cheapest first, and earns at most one strike.
+
 # Suppress messages in all uppercase letters with at least this many characters:
 uppercase_message_suppress_length = 20
+# Share of the letters that must be uppercase; lower values also catch mostly uppercase messages
+uppercase_ratio = 1.0
+
+# Suppress messages longer than this many characters (0 to disable)
+moderation_max_length = 0
+
+# Allow viewers to post web addresses. Blocked addresses are suppressed either way.
+moderation_allow_links = True
+
+# Files of web address domains to block, in addition to the lists in language_watchlist.py.
+# One domain per line; hosts files, URLs and .gz, .bz2 or .xz compressed files also work.
+# Blocking a domain also blocks its subdomains.
+blocklist_files = []
+
+# Flood detection; each flooding message earns a strike
+# A viewer sending this many messages within flood_user_period seconds (0 to disable)
+flood_user_messages = 5
+flood_user_period = 3
+# The same message, from anyone, sent this many times within flood_duplicate_period seconds (0 to disable).
+# Off by default: chat repeats "gg" and emotes often. Chat commands and raffle keywords are never counted.
+flood_duplicate_count = 0
+flood_duplicate_period = 30
+# Memory limits: viewers tracked across all channels, and recent messages kept per channel
+flood_users_max = 10000
+flood_fingerprints_max = 1000
@@ -23,24 +23,25 @@ active_connection = False
 bot_active = False
 
 # Communication Routes
-irc_socket = None
 db_action = None
 
 # Twitch limits user messages to 20 messages in 30 seconds. Failure to obey is
 # an 8-hour global ban. Moderators have an increased limit to 100 messages in 30
 # seconds. The bot will detect whether it is a mod and adjust its rate limit
-# accordingly.
+# accordingly, per channel.
 #
 # Twitch also allows registering a bot as a bot, changing the default allowed
 # message rate. See:
 # https://discuss.dev.twitch.tv/t/have-a-chat-whisper-bot-let-us-know/10651
-message_rate = (20/30)
+#
+# Dictionary of channel:true/false for whether the bot is a moderator there
+bot_is_mod = {}
 
-# Message counter to rate limit messages sent to Twitch
-messages_sent = 0
+# Channels the bot is in, rejoined on reconnect
+joined_channels = set()
 
 # Raffle variables
 # Dictionary of channel:true/false
-raffle_active = False
+raffle_active = {}
 # Dictionary of channel:keyword
-raffle_keyword = None
+raffle_keyword = {}
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_blocklist.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_blocklist.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_blocklist.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_blocklist.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Blocked web address domains. The URL lists in language_watchlist.py and the
+# files in bot_cfg.blocklist_files are loaded into one table of 64-bit domain
+# hashes. A message's hostnames are pulled out in one regex pass, and each
+# hostname is checked along with its parent domains (a.b.example.com,
+# b.example.com, example.com, com), so a blocked domain also blocks its
+# subdomains. A check costs one table lookup per label of the hostname however
+# long the lists are, and each entry takes 16 bytes.
+
+# Core Modules
+import bz2                      # .bz2 compressed lists
+import gzip                     # .gz compressed lists
+import hashlib                  # Stable domain hashes
+import lzma                     # .xz compressed lists
+import re                       # Hostname extraction
+from array import array         # Hash table storage
+# Project Modules
+import bot_cfg                  # Bot's config file
+import fb_log                   # Logging
+import language_watchlist       # Built in URL lists
+
+logger = fb_log.get_logger("moderation")
+
+# Domain table in use, built on first use. Not built at import, so cpu pool
+# processes importing this module do not each load the lists.
+blocked_domains = None
+
+### BLOCKLIST VARIABLES ###
+
+# Dotted hostnames ending in a letter-only top-level domain or an IDNA one
+hostname_pattern = re.compile(r"(?:[^\s/?#:@.,;!<>\"'()\[\]]+\.)+(?:[^\W\d_]{2,}|xn--[\w-]+)")
+
+# Openers by file extension; anything else is read as plain text
+compressed_openers = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+    ".lzma": lzma.open,
+    }
+
+
+### DOMAIN TABLE ###
+
+def _domain_hash(domain):
+    """ Nonzero 64-bit hash of a domain, the same across runs. """
+    digest = hashlib.blake2b(domain.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+class DomainSuffixSet:
+    """ Set of domains stored as hashes in one open-addressed table, kept at most half full. """
+
+    def __init__(self, domains):
+        hashes = { _domain_hash(domain) for domain in domains }
+        size = 8
+        while size < len(hashes) * 2:
+            size *= 2
+        self.mask = size - 1
+        self.table = array("Q", [0]) * size
+        self.count = len(hashes)
+
+        for domain_hash in hashes:
+            slot = domain_hash & self.mask
+            while self.table[slot]:
+                slot = (slot + 1) & self.mask
+            self.table[slot] = domain_hash
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, domain):
+        domain_hash = _domain_hash(domain)
+        slot = domain_hash & self.mask
+        while True:
+            entry = self.table[slot]
+            if entry == domain_hash:
+                return True
+            if not entry:
+                return False
+            slot = (slot + 1) & self.mask
+
+    def match(self, hostname):
+        """ Return the hostname's blocked domain, checking the shortest parent domain first. None if not blocked. """
+        labels = hostname.split(".")
+        for start in range(len(labels) - 1, -1, -1):
+            domain = ".".join(labels[start:])
+            if domain in self:
+                return domain
+        return None
+
+
+### LOADING ###
+
+def _blocklist_entry(line):
+    """ Domain named on a blocklist line, or None. Accepts bare domains, hosts file lines, URLs and ||domain^ rules. """
+    line = line.split("#", 1)[0].strip()
+    if not line or line.startswith("!"):
+        return None
+    # Hosts file lines put the address first
+    entry = line.split()[-1]
+    if "://" in entry:
+        entry = entry.split("://", 1)[1]
+    entry = entry.split("/", 1)[0].strip("|^").lstrip("*.").rstrip(".").lower()
+    return entry or None
+
+def blocklist_read(blocklist_file):
+    """ Yield the domains listed in a plain text or compressed blocklist file. """
+    for extension, opener in compressed_openers.items():
+        if blocklist_file.endswith(extension):
+            break
+    else:
+        opener = open
+
+    with opener(blocklist_file, "rt", encoding="utf-8", errors="replace") as blocklist:
+        for line in blocklist:
+            entry = _blocklist_entry(line)
+            if entry is not None:
+                yield entry
+
+def blocklist_load(blocklist_files=None, url_lists=None):
+    """ Build the domain table from the URL lists (language_watchlist.py's by default) and the blocklist files. """
+    if blocklist_files is None:
+        blocklist_files = bot_cfg.blocklist_files
+    if url_lists is None:
+        url_lists = ( language_watchlist.url_shortener_list, language_watchlist.url_lengthener_list )
+
+    domains = set(domain.lower() for url_list in url_lists for domain in url_list)
+    for blocklist_file in blocklist_files:
+        try:
+            domains.update(blocklist_read(blocklist_file))
+        except OSError as error:
+            logger.error("Unable to read blocklist %s: %s", blocklist_file, error)
+
+    return DomainSuffixSet(domains)
+
+
+### BLOCKLIST CHECK ###
+
+def blocklist_domains():
+    """ The domain table in use, built if need be """
+    global blocked_domains
+    if blocked_domains is None:
+        blocked_domains = blocklist_load()
+    return blocked_domains
+
+def blocklist_match(message, domain_set=None):
+    """ Return the first blocked domain a message links to, or None. """
+    if domain_set is None:
+        domain_set = blocklist_domains()
+
+    for hostname in hostname_pattern.findall(message):
+        blocked = domain_set.match(hostname.lower())
+        if blocked is not None:
+            return blocked
+    return None
@@ -18,147 +18,314 @@
 
 # Core Modules
 from datetime import datetime   # date functions
+from time import monotonic      # Cooldown timing
 # Project Modules
 import bot_cfg                  # Bot's config file
 import config                   # Variables shared between modules
-import fb_common                # Shared functions across modules
+import fb_connection            # Connection to Twitch
 import fb_irc                   # IRC commands
+import fb_log                   # Logging
+import fb_metrics               # Bot statistics
+import fb_raffle                # Raffle entrants
 import fb_sql                   # SQLite database interaction
 import fb_vlc                   # VLC integration
 
-def command_parser(username, user_mod_status, irc_channel, message):
-    irc_channel_broadcaster = irc_channel[1:]
+logger = fb_log.get_logger("commands")
 
-    msg = message.split(" ")
-    # force to lowercase for parsing
-    msg[0] = msg[0].lower()
+### COMMAND REGISTRY ###
 
-    # Bot Administrator Commands
+# Permission tiers; each tier may also use the commands of the tiers below it
+TIER_EVERYONE = 0
+TIER_SUBSCRIBER = 1
+TIER_MODERATOR = 2
+TIER_BROADCASTER = 3
+TIER_ADMIN = 4
+
+# Dictionary of command name or alias:Command
+command_registry = {}
+
+# Dictionary of (channel, command name):time its cooldown ends
+command_last_used = {}
+# Dictionary of (channel, command name, username):time its cooldown ends
+command_user_last_used = {}
+# Dictionary of (channel, reply):time it may be sent again
+command_replies_sent = {}
+# Entries a cooldown table may hold before expired entries are cleared out
+command_state_max = 10000
+
+class Command:
+    """ A chat command: its handler, required tier and allowed argument counts. """
+    __slots__ = ("name", "handler", "tier", "args_min", "args_max")
+
+    def __init__(self, name, handler, tier, args_min, args_max):
+        self.name = name
+        self.handler = handler
+        self.tier = tier
+        self.args_min = args_min
+        self.args_max = args_max
+
+def command(name, aliases=(), tier=TIER_EVERYONE, args=(0, None)):
+    """ Register the decorated function as a chat command.
+
+    The function is called as handler(irc_channel, username, args) with the
+    words after the command. args is the exact number of words accepted, or a
+    (minimum, maximum) tuple where a maximum of None accepts any number. By
+    default any words after the command are accepted, as with "!time please".
+    """
+    if isinstance(args, tuple):
+        args_min, args_max = args
+    else:
+        args_min = args_max = args
+
+    def register(handler):
+        registered = Command(name, handler, tier, args_min, args_max)
+        for command_name in (name, *aliases):
+            # Empty names are commands disabled in bot_cfg
+            if command_name:
+                command_registry[command_name.lower()] = registered
+        return handler
+
+    return register
+
+def user_tier(username, irc_channel, tags):
+    """ Highest permission tier of a chat user, from the message's tags. """
     if username == bot_cfg.bot_admin:
-        # Shut down the bot in a clean manner
-        if msg[0] == "!quit" or msg[0] == "!exit":
-            print(f"LOG: Shutting down on command from: {username}")
-            fb_irc.command_irc_quit()
-            config.irc_socket.close()
-            config.active_connection = False
-            config.bot_active = False
-        # Quit and reconnect to Twitch (test command)
-        elif msg[0] == "!reconnect":
-            print(f"LOG: Reconnecting to IRC server on command from: {username}")
-            fb_irc.command_irc_send_message("Reconnecting; back in a jiffy!")
-            fb_irc.command_irc_part(bot_cfg.channel, True)
-            config.irc_socket.close()
-            config.active_connection = False
-
-    # Broadcaster Commands
-    if username == irc_channel_broadcaster:
-        # Raffle support commands
-        if msg[0] == "!raffle" and len(msg) > 1:
-            msg[1] = msg[1].strip().lower()
-            # Setting a watchword to monitor for in the channel to look for active viewers
-            if msg[1] == "keyword" and len(msg) == 3:
-                # Reset raffle status as new keyword entered
-                fb_sql.db_vt_reset_all_raffle()
-                config.raffle_keyword = msg[2].strip()
-                print(f"LOG: Raffle keyword set to: {config.raffle_keyword}")
-                fb_irc.command_irc_send_message(f"Raffle keyword set to: {config.raffle_keyword}")
-                config.raffle_active = True
-            # Rest all raffle settings
-            elif msg[1] == "clear":
-                print("LOG: Raffle entries cleared.")
-                fb_sql.db_vt_reset_all_raffle()
-                raffle_winner = None
-                raffle_winner_displayname = None
-                config.raffle_keyword = None
-                config.raffle_active = False
-                fb_irc.command_irc_send_message("Raffle settings and contestant entries cleared.")
-            # Announce number of entries in pool
-            elif msg[1] == "count":
-                print(f"LOG: Raffle participants: {str(len(fb_sql.db_vt_show_all_raffle()))}")
-                fb_irc.command_irc_send_message(f"Raffle contestants: {str(len(fb_sql.db_vt_show_all_raffle()))}")
-            # Closing raffle to new entries
-            elif msg[1] == "close":
-                config.raffle_active = False
-                print("LOG: Raffle closed to further entries.")
-                fb_irc.command_irc_send_message("Raffle closed to further entries.")
-            # Reopens raffle to entries
-            elif msg[1] == "reopen":
-                config.raffle_active = True
-                print("LOG: Raffle reopened for entries.")
-                fb_irc.command_irc_send_message("Raffle reopened.")
-            # Selecting a winner from the pool
-            elif msg[1] == "winner":
-                raffle_contestants = fb_sql.db_vt_show_all_raffle()
-                if len(raffle_contestants) == 0:
-                    fb_irc.command_irc_send_message("No winners available; raffle pool is empty.")
-                else:
-                    raffle_winner = raffle_contestants[fb_common.generate_number(0,len(raffle_contestants))]
-                    raffle_winner = raffle_winner[0]
-                    raffle_winner_displayname = fb_sql.db_vt_show_displayname(raffle_winner)
-                    print(f"LOG: Raffle winner: {raffle_winner}")
-                    fb_irc.command_irc_send_message(f"Raffle winner: {raffle_winner_displayname}. Winner's chance was: {str((1/len(raffle_contestants)*100))}%")
-                    # Only allow winner to win once per raffle
-                    fb_sql.db_vt_change_raffle(raffle_winner)
-        # Special effects
-        # First sound command
-        elif msg[0] == bot_cfg.sfx1_alias:
-            fb_vlc.vlc_play_audio(bot_cfg.sfx1_path)
-        # Second sound command
-        elif msg[0] == bot_cfg.sfx2_alias:
-            fb_vlc.vlc_play_audio(bot_cfg.sfx2_path)
-
-
-            # Supporting multiple streamers
-#           elif msg[0] == "!multi":
-                # Multistream support variables
-#               multistream_url = "http://kadgar.net/live/"  + irc_channel_broadcaster + "/"
-#               multistream_url_default = multistream_url
+        return TIER_ADMIN
+    if username == irc_channel[1:]:
+        return TIER_BROADCASTER
+    if tags.get("mod") == "1":
+        return TIER_MODERATOR
+    if tags.get("subscriber") == "1":
+        return TIER_SUBSCRIBER
+    return TIER_EVERYONE
+
+def _expire(timestamps, now):
+    """ Clear entries whose cooldown has ended once a cooldown table grows past command_state_max. """
+    if len(timestamps) > command_state_max:
+        for key in [ key for key, ends in timestamps.items() if ends <= now ]:
+            del timestamps[key]
+
+def _command_cooled_down(registered, irc_channel, username):
+    """ Whether a command is off cooldown in a channel and for the user. Marks it used if so. """
+    cooldown, user_cooldown = bot_cfg.command_cooldowns.get(
+        registered.name, (bot_cfg.command_cooldown, bot_cfg.command_user_cooldown)
+        )
+    now = monotonic()
+    channel_key = (irc_channel, registered.name)
+    user_key = (irc_channel, registered.name, username)
+    if now < command_last_used.get(channel_key, now):
+        return False
+    if now < command_user_last_used.get(user_key, now):
+        return False
+
+    command_last_used[channel_key] = now + cooldown
+    command_user_last_used[user_key] = now + user_cooldown
+    _expire(command_user_last_used, now)
+    return True
+
+def command_reply(irc_channel, reply):
+    """ Send a reply to chat unless the same reply went to the channel within bot_cfg.command_reply_dedup seconds. """
+    now = monotonic()
+    reply_key = (irc_channel, reply)
+    if now < command_replies_sent.get(reply_key, now):
+        return
+    command_replies_sent[reply_key] = now + bot_cfg.command_reply_dedup
+    _expire(command_replies_sent, now)
+    fb_irc.command_irc_send_message(irc_channel, reply)
+
+def command_parser(username, irc_channel, message, tags):
+    """ Run the chat command in a message, if it is one the user may use. """
+    command_name, separator, arguments = message.partition(" ")
+    registered = command_registry.get(command_name.lower())
+    if registered is None:
+        return
+
+    args = arguments.split()
+    if len(args) < registered.args_min:
+        return
+    if registered.args_max is not None and len(args) > registered.args_max:
+        return
+    tier = user_tier(username, irc_channel, tags)
+    if tier < registered.tier:
+        return
+    # Moderators and above are not held to cooldowns
+    if tier < TIER_MODERATOR and not _command_cooled_down(registered, irc_channel, username):
+        return
+
+    registered.handler(irc_channel, username, args)
+
+
+### ADMINISTRATOR COMMANDS ###
+
+@command("!quit", aliases=("!exit",), tier=TIER_ADMIN)
+def command_quit(irc_channel, username, args):
+    """ Shut down the bot in a clean manner """
+    logger.info("Shutting down on command from: %s", username)
+    fb_irc.command_irc_quit(irc_channel)
+    fb_irc.command_irc_disconnect()
+    config.bot_active = False
+
+@command("!reconnect", tier=TIER_ADMIN)
+def command_reconnect(irc_channel, username, args):
+    """ Quit and reconnect to Twitch (test command) """
+    logger.info("Reconnecting to IRC server on command from: %s", username)
+    fb_irc.command_irc_send_message(irc_channel, "Reconnecting; back in a jiffy!")
+    fb_connection.irc_reconnect()
+
+@command("!join", tier=TIER_ADMIN, args=1)
+def command_join(irc_channel, username, args):
+    """ Join another channel """
+    joined_channel = "#" + args[0].lower().lstrip("#")
+    logger.info("Joining %s on command from: %s", joined_channel, username)
+    fb_irc.command_irc_join(joined_channel)
+
+@command("!part", tier=TIER_ADMIN, args=1)
+def command_part(irc_channel, username, args):
+    """ Leave a channel """
+    parted_channel = "#" + args[0].lower().lstrip("#")
+    logger.info("Leaving %s on command from: %s", parted_channel, username)
+    fb_irc.command_irc_part(parted_channel)
+
+@command("!stats", tier=TIER_ADMIN)
+def command_stats(irc_channel, username, args):
+    """ Counters, queue depths and latencies """
+    fb_irc.command_irc_send_message(irc_channel, fb_metrics.metrics_summary())
+
+
+### BROADCASTER COMMANDS ###
+
+@command("!raffle", tier=TIER_BROADCASTER, args=(1, None))
+def command_raffle(irc_channel, username, args):
+    """ Raffle support commands """
+    action = args[0].lower()
+    # Setting a watchword to monitor for in the channel to look for active viewers
+    if action == "keyword" and len(args) == 2:
+        # Reset raffle status as new keyword entered
+        fb_raffle.raffle_open(irc_channel, args[1])
+        logger.info("%s: Raffle keyword set to: %s", irc_channel, config.raffle_keyword[irc_channel])
+        fb_irc.command_irc_send_message(irc_channel, f"Raffle keyword set to: {config.raffle_keyword[irc_channel]}")
+    # Rest all raffle settings
+    elif action == "clear":
+        logger.info("%s: Raffle entries cleared.", irc_channel)
+        fb_raffle.raffle_reset(irc_channel)
+        fb_irc.command_irc_send_message(irc_channel, "Raffle settings and contestant entries cleared.")
+    # Announce number of entries in pool
+    elif action == "count":
+        raffle_contestant_count = fb_raffle.raffle_count(irc_channel)
+        logger.info("%s: Raffle participants: %d", irc_channel, raffle_contestant_count)
+        fb_irc.command_irc_send_message(irc_channel, f"Raffle contestants: {str(raffle_contestant_count)}")
+    # Closing raffle to new entries
+    elif action == "close":
+        config.raffle_active[irc_channel] = False
+        logger.info("%s: Raffle closed to further entries.", irc_channel)
+        fb_irc.command_irc_send_message(irc_channel, "Raffle closed to further entries.")
+    # Reopens raffle to entries
+    elif action == "reopen":
+        config.raffle_active[irc_channel] = True
+        logger.info("%s: Raffle reopened for entries.", irc_channel)
+        fb_irc.command_irc_send_message(irc_channel, "Raffle reopened.")
+    # Selecting a winner from the pool
+    elif action == "winner":
+        # Winner is removed from the pool; only allow winner to win once per raffle
+        raffle_drawing = fb_raffle.raffle_draw_winner(irc_channel)
+        if raffle_drawing is None:
+            fb_irc.command_irc_send_message(irc_channel, "No winners available; raffle pool is empty.")
+        else:
+            raffle_winner, raffle_contestant_count = raffle_drawing
+            raffle_winner_displayname = fb_sql.db_vt_show_displayname(irc_channel, raffle_winner)
+            logger.info("%s: Raffle winner: %s", irc_channel, raffle_winner)
+            fb_irc.command_irc_send_message(irc_channel, f"Raffle winner: {raffle_winner_displayname}. Winner's chance was: {str((1/raffle_contestant_count*100))}%")
+
+# Special effects
+@command(bot_cfg.sfx1_alias, tier=TIER_BROADCASTER)
+def command_sfx1(irc_channel, username, args):
+    """ First sound command """
+    fb_vlc.vlc_enqueue(bot_cfg.sfx1_path)
+
+@command(bot_cfg.sfx2_alias, tier=TIER_BROADCASTER)
+def command_sfx2(irc_channel, username, args):
+    """ Second sound command """
+    fb_vlc.vlc_enqueue(bot_cfg.sfx2_path)
+
+
+# Supporting multiple streamers
+#@command("!multi", tier=TIER_BROADCASTER, args=(0, 2))
+#def command_multi(irc_channel, username, args):
+#    # Multistream support variables
+#    multistream_url = "http://kadgar.net/live/" + irc_channel[1:] + "/"
+#    multistream_url_default = multistream_url
 #
-#               if len(msg) > 1:
-#                   msg[1] = msg[1].strip().lower()
-#                   if msg[1] == "add" and len(msg) == 3:
-#                       multistream_url = multistream_url + msg[2].strip() + "/"
-#                       print("LOG: Multistream URL set to: " + multistream_url)
-#                       fb_irc.command_irc_send_message("Multistream URL set to: " + multistream_url)
-                    # TODO split this into a reset command
-#                   if msg[1] == "set" and len(msg) == 3:
-#                       if msg[2].lower() == "default":
-#                           multistream_url = multistream_url_default
-#                           print("LOG: Multistream URL reset to default.")
-#                           fb_irc.command_irc_send_message("Multistream URL reset to default.")
-#                       else:
-#                           multistream_url = msg[2].strip()
-#                           print("LOG: Multistream URL set to: " + multistream_url)
-#                           fb_irc.command_irc_send_message("Multistream URL set: " + multistream_url)
-#                   else:
-#                       print("LOG: Unknown usage of !multi.")
-#                       fb_irc.command_irc_send_message("Unknown usage of !multi.")
-#               else:
-#                   fb_irc.command_irc_send_message("Multistream URL is: " + multistream_url)
-
-    # Editor Commands
-
-    # Moderator Commands
-#   if user mod status == true or username == broadcaster:
-    if username == irc_channel_broadcaster: #or user_mod_status == ???
-        if msg[0] == "!voice" and len(msg) == 2:
-            pardoned_user = msg[1].strip().lower()
-            fb_irc.command_irc_untimeout(pardoned_user)
-            del pardoned_user
-
-    # Subscriber Commands
-
-    # Follower Commands
-
-    # Commands available to everyone
-    if msg[0] == "!test":
-        fb_irc.command_irc_send_message("All systems nominal.")
-    elif (msg[0] == "!xbl" or msg[0] == "!xb1") and bot_cfg.xbox_handle != "":
-        fb_irc.command_irc_send_message(f"Broadcaster's XBL ID is: {bot_cfg.xbox_handle}")
-    elif (msg[0] == "!psn" or msg[0] == "!ps4") and bot_cfg.playstation_handle != "":
-        fb_irc.command_irc_send_message(f"Broadcaster's PSN ID is: {bot_cfg.playstation_handle}")
-    elif (msg[0] == "!steam" and bot_cfg.steam_handle != ""):
-        fb_irc.command_irc_send_message(f"Broadcaster's Steam ID is: {bot_cfg.steam_handle}")
-    elif msg[0] == "!time" or msg[0] == "!clock":
-        now_local = datetime.now().strftime("%A %I:%M%p")
-        fb_irc.command_irc_send_message(f"Stream time is: {now_local}")
+#    if len(args) > 0:
+#        action = args[0].lower()
+#        if action == "add" and len(args) == 2:
+#            multistream_url = multistream_url + args[1] + "/"
+#            logger.info("Multistream URL set to: %s", multistream_url)
+#            fb_irc.command_irc_send_message(irc_channel, "Multistream URL set to: " + multistream_url)
+#        # TODO split this into a reset command
+#        elif action == "set" and len(args) == 2:
+#            if args[1].lower() == "default":
+#                multistream_url = multistream_url_default
+#                logger.info("Multistream URL reset to default.")
+#                fb_irc.command_irc_send_message(irc_channel, "Multistream URL reset to default.")
+#            else:
+#                multistream_url = args[1]
+#                logger.info("Multistream URL set to: %s", multistream_url)
+#                fb_irc.command_irc_send_message(irc_channel, "Multistream URL set: " + multistream_url)
+#        else:
+#            logger.info("Unknown usage of !multi.")
+#            fb_irc.command_irc_send_message(irc_channel, "Unknown usage of !multi.")
+#    else:
+#        fb_irc.command_irc_send_message(irc_channel, "Multistream URL is: " + multistream_url)
+
+### EDITOR COMMANDS ###
+
+
+### MODERATOR COMMANDS ###
+
+@command("!voice", tier=TIER_MODERATOR, args=1)
+def command_voice(irc_channel, username, args):
+    """ Restore chat privileges to a banned or timed out viewer """
+    fb_irc.command_irc_untimeout(irc_channel, args[0].lower())
+
+@command("!sfx", tier=TIER_MODERATOR, args=1)
+def command_sfx(irc_channel, username, args):
+    """ Skip the playing sound effect, or stop it and clear the queue """
+    action = args[0].lower()
+    if action == "skip":
+        fb_vlc.vlc_skip()
+    elif action == "stop":
+        logger.info("%s: Sound effects stopped by: %s", irc_channel, username)
+        fb_vlc.vlc_stop()
+
+
+### SUBSCRIBER COMMANDS ###
+
+
+### FOLLOWER COMMANDS ###
+
+
+### COMMANDS AVAILABLE TO EVERYONE ###
+
+@command("!time", aliases=("!clock",))
+def command_time(irc_channel, username, args):
+    now_local = datetime.now().strftime("%A %I:%M%p")
+    command_reply(irc_channel, f"Stream time is: {now_local}")
+
+def command_static_load():
+    """ (Re)register the commands whose replies never change, with their replies built once here. """
+    static_replies = (
+        ( ("!test",), "All systems nominal." ),
+        ( ("!xbl", "!xb1"), bot_cfg.xbox_handle and f"Broadcaster's XBL ID is: {bot_cfg.xbox_handle}" ),
+        ( ("!psn", "!ps4"), bot_cfg.playstation_handle and f"Broadcaster's PSN ID is: {bot_cfg.playstation_handle}" ),
+        ( ("!steam",), bot_cfg.steam_handle and f"Broadcaster's Steam ID is: {bot_cfg.steam_handle}" ),
+        )
+    for names, reply in static_replies:
+        for command_name in names:
+            command_registry.pop(command_name, None)
+        # Commands without a reply, such as an empty game handle, are not registered
+        if reply:
+            command(names[0], aliases=names[1:])(
+                lambda irc_channel, username, args, reply=reply: command_reply(irc_channel, reply)
+                )
+
+command_static_load()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_connection.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_connection.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_connection.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_connection.py. If not, see <http://www.gnu.org/licenses/>.
+
+# A connection to Twitch runs as three tasks:
+#   reader:    reads lines off the socket, answers PINGs at once and queues the rest
+#   processor: hands queued lines to the bot's line handler
+#   writer:    sends queued outbound lines as fb_irc's rate windows allow
+# Pacing outbound messages never holds up reading or PING replies.
+#
+# Each connection goes disconnected -> connecting -> logging in -> connected ->
+# disconnected, with every step before connected under a time limit. Failed
+# attempts are retried after a randomized, doubling delay. A connection that
+# was up for a while, or that Twitch asked the bot to remake, is remade at
+# once, without waiting for queued replies. The database cache, raffles, rate
+# windows and recently queued moderation actions carry over to the new
+# connection, where channels are rejoined ahead of anything else.
+
+# Core Modules
+import asyncio              # Asynchronous networking
+import codecs               # Incremental UTF-8 decoding
+import random               # Backoff jitter
+from collections import deque   # Lines framed but not yet handed out
+from time import monotonic  # Connection lifetimes
+# Project Modules
+import bot_cfg              # Bot's config file
+import config               # Variables shared between modules
+import fb_irc               # IRC commands
+import fb_log               # Logging
+import fb_metrics           # Line counters
+import fb_parser            # IRC line parser
+
+logger = fb_log.get_logger("irc")
+
+### NETWORK VARIABLES ###
+
+# Batches of lines waiting for the processor. When full, reading pauses until there is room.
+inbound_queue_size = 100
+# The current connection's queue of batches
+inbound_queue = None
+
+# Bytes asked for per read from the socket
+receive_size = 65536
+# A partial line growing past this many bytes is discarded
+line_size_max = 65536
+
+# Connection states
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_LOGGING_IN = "logging in"
+STATE_CONNECTED = "connected"
+connection_state = STATE_DISCONNECTED
+
+# Seconds allowed to open the connection, and to log in
+connect_timeout = 10
+login_timeout = 15
+# Lines the server may send before logging in is given up on
+login_lines_max = 100
+# After this many seconds without hearing from the server the bot sends a PING,
+# and reconnects if there is still nothing ping_timeout seconds later
+keepalive_interval = 90
+ping_timeout = 15
+# Delay before retrying after a failed attempt: doubles per failure up to
+# backoff_max, then a random 50-100% of it is used
+backoff_base = 1
+backoff_max = 120
+# A connection up for this many seconds counts as a success; shorter ones as failures
+connection_stable = 30
+# Set to reconnect at once when the current connection ends
+reconnect_requested = False
+# Set to cut the wait before the next attempt short, when shutting down
+backoff_wakeup = None
+
+
+### LINE FRAMING ###
+
+class IRCLineReader:
+    """ Frames lines out of the byte stream from the server.
+
+    Large reads are collected in one buffer and cut at the last line ending, so
+    every complete line in a read is decoded with a single call and a partial
+    line or character simply waits in the buffer for the next read.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = bytearray()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.pending_lines = deque()
+        # Set after an oversized line is discarded, until the rest of it has been read
+        self.discarding = False
+
+    async def read_lines(self):
+        """ Return the next batch of complete lines. None once the connection closes. """
+        if self.pending_lines:
+            lines = list(self.pending_lines)
+            self.pending_lines.clear()
+            return lines
+
+        while True:
+            try:
+                data = await self.reader.read(receive_size)
+            except ConnectionError:
+                return None
+            if not data:
+                return None
+            if self.discarding:
+                # Drop the rest of the oversized line, up to and including its line ending
+                start = data.find(b"\n")
+                if start == -1:
+                    continue
+                self.discarding = False
+                data = data[start + 1:]
+            self.buffer += data
+
+            end = self.buffer.rfind(b"\n")
+            if end == -1:
+                if len(self.buffer) > line_size_max:
+                    logger.error("Oversized line from server discarded.")
+                    fb_metrics.metrics_count("lines_dropped", "oversized")
+                    self.buffer.clear()
+                    self.decoder.reset()
+                    self.discarding = True
+                continue
+
+            with memoryview(self.buffer) as buffer_view:
+                text = self.decoder.decode(buffer_view[:end + 1])
+            del self.buffer[:end + 1]
+
+            # The text ends with a line ending, which leaves an empty string last
+            lines = text.split("\n")
+            lines.pop()
+            return [ line[:-1] if line.endswith("\r") else line for line in lines ]
+
+    async def readline(self):
+        """ Return the next single line. None once the connection closes. """
+        while not self.pending_lines:
+            lines = await self.read_lines()
+            if lines is None:
+                return None
+            self.pending_lines.extend(lines)
+
+        return self.pending_lines.popleft()
+
+
+### CONNECTION TASKS ###
+
+async def _irc_reader(line_reader, inbound_queue):
+    """ Queue batches of lines from the server for the processor. PINGs are answered here. """
+    ping_sent = False
+    while config.active_connection:
+        try:
+            lines = await asyncio.wait_for(
+                line_reader.read_lines(), ping_timeout if ping_sent else keepalive_interval
+                )
+        except asyncio.TimeoutError:
+            if ping_sent:
+                logger.error("Server stopped responding.")
+                break
+            # Check the connection is still alive
+            fb_irc.irc_send("PING :tmi.twitch.tv", fb_irc.PRIORITY_PONG)
+            ping_sent = True
+            continue
+        if lines is None:
+            break
+        ping_sent = False
+        fb_metrics.metrics_count("lines_received", amount=len(lines))
+        for line in lines:
+            # Twitch will check that clients are still alive; respond with PONG
+            if line.startswith("PING "):
+                fb_irc.command_irc_ping_respond()
+                logger.debug("Received PING. Sent PONG.")
+        await inbound_queue.put(lines)
+
+async def _irc_processor(inbound_queue, line_handler):
+    """ Pass queued lines to the line handler until the None sentinel arrives. """
+    while True:
+        lines = await inbound_queue.get()
+        if lines is None:
+            break
+        for line in lines:
+            # Blank lines and PINGs answered by the reader
+            if not line or line.startswith("PING "):
+                continue
+            try:
+                line_handler(line)
+            except Exception:
+                logger.exception("Failed to process message: %s", line)
+                fb_metrics.metrics_count("lines_dropped", "error")
+
+async def _irc_writer(writer):
+    """ Send queued lines to the server until the None sentinel arrives, then close. """
+    try:
+        while True:
+            # Rate control on sending messages
+            line = await fb_irc.irc_next_line()
+            if line is None:
+                break
+            writer.write(f"{line}\r\n".encode("utf-8"))
+            await writer.drain()
+    except ConnectionError:
+        logger.error("Connection lost while sending.")
+    finally:
+        writer.close()
+
+async def _irc_login(line_reader, writer):
+    """ Log in to Twitch. Returns True on success. """
+    # Request full messaging metadata from IRC messages
+    writer.write(
+        ( "CAP REQ :twitch.tv/tags twitch.tv/commands twitch.tv/membership\r\n"
+          f"PASS {bot_cfg.bot_password}\r\n"
+          f"NICK {bot_cfg.bot_handle}\r\n" ).encode("utf-8")
+        )
+    await writer.drain()
+
+    # Initial login messages
+    for login_line in range(login_lines_max):
+        line = await line_reader.readline()
+        if line is None:
+            logger.error("Connection closed while logging in.")
+            return False
+        logger.debug("%s", line)
+        irc_message = fb_parser.parse_irc_line(line)
+        if irc_message is None:
+            continue
+        # Connected to Twitch IRC server but failed to login
+        if irc_message.command == "NOTICE":
+            logger.error("Login failed: %s", irc_message.trailing)
+            return False
+        # Last line of a successful login
+        elif irc_message.command == "376":
+            return True
+
+    logger.error("No end to the login messages after %d lines.", login_lines_max)
+    return False
+
+
+### CONNECTION ###
+
+def inbound_queue_depth():
+    """ Number of received batches of lines waiting for the processor """
+    return inbound_queue.qsize() if inbound_queue is not None else 0
+
+fb_metrics.metrics_gauge("inbound_queue_depth", "Batches of received lines waiting to be handled.", inbound_queue_depth)
+fb_metrics.metrics_gauge("connected", "1 while logged in to Twitch.", lambda: int(connection_state == STATE_CONNECTED))
+
+def irc_reconnect():
+    """ Close the connection once the queued lines are sent and open a new one straight away """
+    global reconnect_requested
+    reconnect_requested = True
+    # Queued moderation actions carry over; waiting on the rate windows would only delay the new connection
+    fb_irc.command_irc_disconnect(immediately=True)
+
+def irc_shutdown():
+    """ Shut the bot down: close the connection once the queued lines are sent, or stop waiting to reconnect """
+    config.bot_active = False
+    fb_irc.command_irc_disconnect()
+    if backoff_wakeup is not None:
+        backoff_wakeup.set()
+
+async def irc_session(line_handler):
+    """ Connect to Twitch, join the bot's channels and process messages until disconnected.
+
+    Returns the seconds the connection was up after logging in, or None if
+    connecting or logging in failed.
+    """
+    global connection_state, inbound_queue
+    config.active_connection = False
+    connection_state = STATE_CONNECTING
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(bot_cfg.host_server, bot_cfg.host_port), connect_timeout
+            )
+    except (OSError, asyncio.TimeoutError) as error:
+        logger.error("Unable to connect to %s:%s: %r", bot_cfg.host_server, bot_cfg.host_port, error)
+        fb_metrics.metrics_count("connections", "connect_failed")
+        connection_state = STATE_DISCONNECTED
+        return None
+
+    fb_irc.irc_send_reset()
+    line_reader = IRCLineReader(reader)
+    connection_state = STATE_LOGGING_IN
+    try:
+        logged_in = await asyncio.wait_for(_irc_login(line_reader, writer), login_timeout)
+    except asyncio.TimeoutError:
+        logger.error("Login timed out.")
+        logged_in = False
+    except ConnectionError:
+        logged_in = False
+    if not logged_in:
+        writer.close()
+        fb_metrics.metrics_count("connections", "login_failed")
+        connection_state = STATE_DISCONNECTED
+        return None
+
+    logger.info("Connected to %s:%s.", bot_cfg.host_server, bot_cfg.host_port)
+    fb_metrics.metrics_count("connections", "connected")
+    connected_at = monotonic()
+    connection_state = STATE_CONNECTED
+    config.active_connection = True
+    inbound_queue = asyncio.Queue(maxsize=inbound_queue_size)
+    writer_task = asyncio.ensure_future(_irc_writer(writer))
+    processor_task = asyncio.ensure_future(_irc_processor(inbound_queue, line_handler))
+
+    # Join broadcasters' channels
+    fb_irc.command_irc_rejoin_all()
+
+    # Runs until the server closes the connection or the bot disconnects
+    await _irc_reader(line_reader, inbound_queue)
+
+    # Finish processing what was received. When shutting down, send what is left
+    # and close. Otherwise the connection was lost or is being remade: stop the
+    # writer rather than wait on the rate windows.
+    await inbound_queue.put(None)
+    await processor_task
+    config.active_connection = False
+    if not config.bot_active:
+        fb_irc.irc_send(None)
+        await writer_task
+    else:
+        writer_task.cancel()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            pass
+        writer.close()
+    connection_state = STATE_DISCONNECTED
+
+    return monotonic() - connected_at
+
+async def irc_run(line_handler):
+    """ Stay connected to Twitch until the bot shuts down """
+    global reconnect_requested, backoff_wakeup
+    backoff_wakeup = asyncio.Event()
+    failures = 0
+    while config.bot_active:
+        reconnect_requested = False
+        connected_for = await irc_session(line_handler)
+        if not config.bot_active:
+            break
+
+        if reconnect_requested or ( connected_for is not None and connected_for >= connection_stable ):
+            failures = 0
+            logger.info("Reconnecting.")
+            continue
+
+        failures += 1
+        delay = min(backoff_base * 2 ** (failures - 1), backoff_max) * random.uniform(0.5, 1.0)
+        logger.info("Reconnecting in %.1f seconds.", delay)
+        try:
+            await asyncio.wait_for(backoff_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_currency.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_currency.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_currency.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_currency.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Core Modules
+import asyncio              # Periodic accrual task
+# Project Modules
+import bot_cfg              # Bot's config file
+import fb_sql               # SQLite database interaction
+
+### PRESENCE TRACKING ###
+
+# Dictionary of channel:set of usernames currently in chat, fed by JOIN, PART and chat messages
+viewers_present = {}
+
+def presence_join(channel, user):
+    """ Mark a viewer as present in a channel. """
+    if user != bot_cfg.bot_handle:
+        viewers_present.setdefault(channel, set()).add(user)
+
+def presence_part(channel, user):
+    """ Mark a viewer as gone from a channel. """
+    channel_viewers = viewers_present.get(channel)
+    if channel_viewers is not None:
+        channel_viewers.discard(user)
+
+def presence_clear(channel=None):
+    """ Forget who is present in one channel, or in all of them. """
+    if channel is None:
+        viewers_present.clear()
+    else:
+        viewers_present.pop(channel, None)
+
+def presence_count(channel):
+    """ Number of viewers present in a channel. """
+    return len(viewers_present.get(channel, ()))
+
+
+### CURRENCY ACCRUAL ###
+
+def currency_accrual_tick():
+    """ Credit every present viewer with currency, one batch per channel. """
+    for channel, channel_viewers in viewers_present.items():
+        if channel_viewers:
+            fb_sql.db_vt_change_currency_many(channel, channel_viewers, bot_cfg.currency_amount)
+
+async def currency_accrual():
+    """ Award currency to viewers in chat every bot_cfg.currency_interval seconds. """
+    while True:
+        await asyncio.sleep(bot_cfg.currency_interval)
+        if bot_cfg.currency_amount != 0:
+            currency_accrual_tick()
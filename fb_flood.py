@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_flood.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_flood.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_flood.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_flood.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Flood detection over sliding time windows:
+#   user rate:  one viewer sending bot_cfg.flood_user_messages messages within
+#               flood_user_period seconds
+#   duplicates: the same message, from anyone, seen flood_duplicate_count times
+#               in a channel within flood_duplicate_period seconds
+# Each check touches a fixed number of entries plus the ones expiring, so it
+# stays constant time on average however fast chat moves. Memory is capped by
+# flood_users_max and flood_fingerprints_max.
+
+# Core Modules
+from collections import OrderedDict, deque  # Recent senders and message rings
+from time import monotonic                  # Window timing
+# Project Modules
+import bot_cfg                              # Bot's config file
+import config                               # Variables shared between modules
+
+### FLOOD VARIABLES ###
+
+# Dictionary of (channel, username):deque of recent message times, least recently active first
+flood_user_times = OrderedDict()
+# Dictionary of channel:deque of (time, fingerprint) of recent messages, oldest first
+flood_fingerprint_ring = {}
+# Dictionary of channel:dictionary of fingerprint:times seen in the ring
+flood_fingerprint_counts = {}
+
+# Verdicts
+FLOOD_RATE = "rate"
+FLOOD_DUPLICATE = "duplicate"
+
+
+### HELPER FUNCTIONS ###
+
+def _message_fingerprint(message):
+    """ Hash of a message ignoring case and spacing, so trivial variations still match. """
+    return hash(" ".join(message.casefold().split()))
+
+def _user_rate_check(channel, user, now):
+    """ Record a message from a viewer. True if they reached the message rate limit. """
+    limit = bot_cfg.flood_user_messages
+    if limit <= 0:
+        return False
+
+    key = (channel, user)
+    times = flood_user_times.get(key)
+    if times is None or times.maxlen != limit:
+        times = flood_user_times[key] = deque(maxlen=limit)
+    else:
+        flood_user_times.move_to_end(key)
+    times.append(now)
+
+    # Forget viewers who have been quiet for a whole window, and the least active past the cap
+    period = bot_cfg.flood_user_period
+    while flood_user_times:
+        oldest_key, oldest_times = next(iter(flood_user_times.items()))
+        if ( oldest_times and now - oldest_times[-1] < period and
+             len(flood_user_times) <= bot_cfg.flood_users_max ):
+            break
+        flood_user_times.popitem(last=False)
+
+    if len(times) == limit and now - times[0] < period:
+        # Start over so the next strike takes another full burst
+        times.clear()
+        return True
+    return False
+
+def _duplicate_check(channel, message, now):
+    """ Record a message in the channel's ring. True if it was seen often enough to be a flood. """
+    threshold = bot_cfg.flood_duplicate_count
+    if threshold <= 0:
+        return False
+
+    ring = flood_fingerprint_ring.get(channel)
+    if ring is None:
+        ring = flood_fingerprint_ring[channel] = deque()
+        flood_fingerprint_counts[channel] = {}
+    counts = flood_fingerprint_counts[channel]
+
+    # Expire by age, then by size
+    period = bot_cfg.flood_duplicate_period
+    while ring and ( now - ring[0][0] >= period or len(ring) >= bot_cfg.flood_fingerprints_max ):
+        expired = ring.popleft()[1]
+        if counts[expired] == 1:
+            del counts[expired]
+        else:
+            counts[expired] -= 1
+
+    fingerprint = _message_fingerprint(message)
+    ring.append((now, fingerprint))
+    seen = counts.get(fingerprint, 0) + 1
+    counts[fingerprint] = seen
+
+    return seen >= threshold
+
+
+### FLOOD CHECK ###
+
+def flood_check(channel, user, message, now=None):
+    """ Record a chat message. Returns FLOOD_RATE or FLOOD_DUPLICATE for a flood, otherwise None. """
+    if now is None:
+        now = monotonic()
+    # Both windows are updated even when the first one trips
+    rate_flood = _user_rate_check(channel, user, now)
+    # Chat commands and an open raffle's keyword repeat by nature; cooldowns and raffle entry keep them in check
+    duplicate_flood = (
+        not message.startswith("!") and
+        not ( config.raffle_active.get(channel, False) and message.strip() == config.raffle_keyword.get(channel) ) and
+        _duplicate_check(channel, message, now)
+        )
+
+    if rate_flood:
+        return FLOOD_RATE
+    if duplicate_flood:
+        return FLOOD_DUPLICATE
+    return None
+
+def flood_clear(channel=None):
+    """ Forget recent messages in one channel, or in all of them. """
+    if channel is None:
+        flood_user_times.clear()
+        flood_fingerprint_ring.clear()
+        flood_fingerprint_counts.clear()
+        return
+
+    for key in [ key for key in flood_user_times if key[0] == channel ]:
+        del flood_user_times[key]
+    flood_fingerprint_ring.pop(channel, None)
+    flood_fingerprint_counts.pop(channel, None)
@@ -17,53 +17,193 @@
 # fb_irc.py. If not, see <http://www.gnu.org/licenses>.
 
 # Core Modules
-from time import sleep      # sleep() command
+import asyncio              # Waking the writer when lines are queued
+from collections import deque   # Send lanes and rate windows
+from time import monotonic  # Rate window timing
 # Project Modules
-from bot_cfg import channel # Only need the channel from bot_cfg
 import config               # Variables shared between modules
+import fb_metrics           # Send queue metrics
+
+### OUTBOUND SCHEDULER ###
+
+# Outbound lines wait in one lane per priority, as (line, time queued). The writer
+# always takes from the most urgent lane with a line whose rate windows have room,
+# so channels are joined before anything is said in them and moderation actions
+# never queue behind command replies. Within a lane, a line held by a full window
+# does not hold up the lines behind it that other windows allow, such as replies
+# to channels where the bot is a moderator behind ones where it is not.
+PRIORITY_PONG = 0
+PRIORITY_JOIN = 1
+PRIORITY_MODERATION = 2
+PRIORITY_REPLY = 3
+irc_send_lanes = ( deque(), deque(), deque(), deque() )
+# Set whenever a line is queued; None until the first connection
+irc_send_wakeup = None
+# Moderation actions still queued when a connection drops are sent on the next
+# one if they were queued less than this many seconds before it
+send_stale_after = 30
+
+# Twitch allows 100 chat messages in any 30 second window, of which only 20 may
+# go to channels where the bot is not a moderator, and 50 JOINs in any 15 second
+# window. The send times inside each window are kept, so a message goes out the
+# moment the oldest send leaves the window.
+message_period = 30
+message_limit_mod = 100
+message_limit_user = 20
+join_limit = 50
+join_period = 15
+message_sends = deque()
+user_message_sends = deque()
+join_sends = deque()
+
+def _window_delay(sends, limit, period, now):
+    """ Seconds until one more send fits in the rate window. 0 if it fits now. """
+    while sends and now - sends[0] >= period:
+        sends.popleft()
+    if len(sends) < limit:
+        return 0
+    # The limit may have been lowered with more sends than that inside the window
+    return sends[len(sends) - limit] + period - now
+
+def _line_windows(line):
+    """ Rate windows a line is counted against as (sends, limit, period) tuples. """
+    if line.startswith("PRIVMSG "):
+        channel = line.split(" ", 2)[1]
+        if config.bot_is_mod.get(channel, False):
+            return ( (message_sends, message_limit_mod, message_period), )
+        return ( (message_sends, message_limit_mod, message_period),
+                 (user_message_sends, message_limit_user, message_period) )
+    elif line.startswith("JOIN "):
+        return ( (join_sends, join_limit, join_period), )
+    return ()
+
+def irc_set_mod_status(channel, bot_is_mod):
+    """ Record whether the bot is a moderator in a channel, which changes its message limit. """
+    config.bot_is_mod[channel] = bot_is_mod
+    # The writer may be waiting on the old limit
+    if irc_send_wakeup is not None:
+        irc_send_wakeup.set()
+
+def irc_send_queue_depth():
+    """ Number of lines waiting to be sent """
+    return sum(len(lane) for lane in irc_send_lanes)
+
+fb_metrics.metrics_gauge("send_queue_depth", "Lines waiting in the send lanes.", irc_send_queue_depth)
+
+def irc_send_reset():
+    """ Prepare the lanes for a new connection. Rate windows and recent moderation actions are kept. """
+    global irc_send_wakeup
+    now = monotonic()
+    # PONGs, JOINs, replies to chat and the disconnect sentinel belong to the old connection
+    kept = [ (line, queued_at) for line, queued_at in irc_send_lanes[PRIORITY_MODERATION]
+             if line is not None and now - queued_at < send_stale_after ]
+    for lane in irc_send_lanes:
+        lane.clear()
+    irc_send_lanes[PRIORITY_MODERATION].extend(kept)
+    irc_send_wakeup = asyncio.Event()
+
+def irc_send(line, priority=PRIORITY_REPLY):
+    """ Queue a raw line for the connection's writer """
+    if irc_send_wakeup is not None:
+        irc_send_lanes[priority].append((line, monotonic()))
+        irc_send_wakeup.set()
+
+async def irc_next_line():
+    """ Wait for the next line the rate windows allow to be sent and return it. """
+    while True:
+        now = monotonic()
+        wait = None
+        # Windows found full; lines counted against them are passed over
+        full_windows = set()
+        for lane in irc_send_lanes:
+            for index, (line, queued_at) in enumerate(lane):
+                # The disconnect sentinel goes after everything queued before it
+                if line is None:
+                    if index == 0:
+                        lane.popleft()
+                        return None
+                    break
+
+                windows = _line_windows(line)
+                if any(id(sends) in full_windows for sends, limit, period in windows):
+                    continue
+                delay = 0
+                for sends, limit, period in windows:
+                    window_delay = _window_delay(sends, limit, period, now)
+                    if window_delay > 0:
+                        full_windows.add(id(sends))
+                        delay = max(delay, window_delay)
+                if delay <= 0:
+                    for sends, limit, period in windows:
+                        sends.append(now)
+                    del lane[index]
+                    fb_metrics.metrics_observe("send_wait", now - queued_at)
+                    fb_metrics.metrics_count("lines_sent", line.split(" ", 1)[0])
+                    return line
+                if wait is None or delay < wait:
+                    wait = delay
+
+        irc_send_wakeup.clear()
+        try:
+            await asyncio.wait_for(irc_send_wakeup.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
 
 ### IRC COMMANDS ###
 
-def command_irc_send_message(msg):
+def command_irc_send_message(channel, msg, priority=PRIORITY_REPLY):
     """ Send a message to the specified channel """
-    config.irc_socket.send(f"PRIVMSG {channel} :{msg}\r\n".encode("utf-8"))
-    config.messages_sent += 1
+    irc_send(f"PRIVMSG {channel} :{msg}", priority)
 
-def command_irc_ban(user):
+def command_irc_ban(channel, user):
     """ Ban a user """
-    command_irc_send_message(f".ban {user}")
+    command_irc_send_message(channel, f".ban {user}", PRIORITY_MODERATION)
 
-def command_irc_timeout(user, seconds=600):
+def command_irc_timeout(channel, user, seconds=600):
     """ Silence user for X seconds (default 10 minutes) """
-    command_irc_send_message(f".timeout {user} {seconds}")
+    command_irc_send_message(channel, f".timeout {user} {seconds}", PRIORITY_MODERATION)
 
-def command_irc_unban(user):
+def command_irc_unban(channel, user):
     """ Unban a user """
-    command_irc_send_message(f".unban {user}")
+    command_irc_send_message(channel, f".unban {user}", PRIORITY_MODERATION)
 
-def command_irc_untimeout(user):
+def command_irc_untimeout(channel, user):
     """ End a user timeout  """
-    command_irc_send_message(f".untimeout {user}")
+    command_irc_send_message(channel, f".untimeout {user}", PRIORITY_MODERATION)
 
 def command_irc_join(channel, reconnect=False):
-    """ Join specified channel """
-    config.irc_socket.send(f"JOIN {channel}\r\n".encode("utf-8"))
-    config.messages_sent += 1
-    # Rate limit of 50 JOINs in 15 seconds or about 3 per second
-    sleep( 1 / (50 / 15))
+    """ Join specified channel. On reconnect the channel is already in the joined set. """
+    if not reconnect:
+        if channel in config.joined_channels:
+            return
+        config.joined_channels.add(channel)
+    irc_send(f"JOIN {channel}", PRIORITY_JOIN)
+
+def command_irc_rejoin_all():
+    """ Join every channel in the joined set, such as after connecting """
+    for channel in sorted(config.joined_channels):
+        command_irc_join(channel, True)
 
 def command_irc_part(channel, reconnect=False):
-    """ Depart specified channel """
-    config.irc_socket.send(f"PART {channel}\r\n".encode("utf-8"))
-    config.messages_sent += 1
+    """ Depart specified channel. On reconnect the channel stays in the joined set. """
+    if not reconnect:
+        config.joined_channels.discard(channel)
+        config.bot_is_mod.pop(channel, None)
+    irc_send(f"PART {channel}")
 
 def command_irc_ping_respond():
     """ Response to PINGs from the server """
-    config.irc_socket.send("PONG :tmi.twitch.tv\r\n".encode("utf-8"))
-    config.messages_sent += 1
+    irc_send("PONG :tmi.twitch.tv", PRIORITY_PONG)
 
-def command_irc_quit():
-    """ Leave channel with a departure message """
-    command_irc_send_message("Shutting down.")
-    command_irc_part(channel)
+def command_irc_disconnect(immediately=False):
+    """ Close the connection once the queued lines have been sent, or at once without sending them """
+    config.active_connection = False
+    # Queued behind every pending reply so they are sent first, or ahead of them all
+    irc_send(None, PRIORITY_PONG if immediately else PRIORITY_REPLY)
 
+def command_irc_quit(channel):
+    """ Leave all channels with a departure message to the given one """
+    command_irc_send_message(channel, "Shutting down.")
+    for joined_channel in sorted(config.joined_channels):
+        command_irc_part(joined_channel)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_loadtest.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_loadtest.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_loadtest.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_loadtest.py. If not, see <http://www.gnu.org/licenses/>.
+
+# End to end load test. Starts the fake chat server of fb_tmi.py and the bot
+# in its own process, connected to it, then sends a burst of generated chat,
+# such as a raid, for a set time. While it runs, the bot's stats endpoint is
+# read to follow how many chat messages it has handled. Reports:
+#   how many chat messages per second the bot handled, and how far behind it fell
+#   how long the bot took to time out or ban viewers breaking the rules
+#   how quickly PINGs were answered
+#   whether the bot's messages and JOINs stayed inside Twitch's rate windows
+#
+# Usage: python3 fb_loadtest.py --rate 500 --users 5000 --duration 30 #raid
+
+# Core Modules
+import argparse                 # Command line
+import asyncio                  # Running the server and reading stats
+import multiprocessing as mp    # The bot's process
+import signal                   # Leaving interrupts to the test
+import socket                   # Finding a free port
+from time import monotonic
+# Project Modules
+import bot_cfg                  # Bot's config file
+import fb_log                   # Logging
+import fb_tmi                   # Fake chat server
+import foundationalbot          # The bot under test
+
+### LOAD TEST VARIABLES ###
+
+# Account the bot logs in as, and the administrator who stops it at the end
+loadtest_handle = "loadtestbot"
+loadtest_admin = "loadtestadmin"
+# Seconds between reads of the bot's stats
+stats_interval = 0.25
+# Seconds to wait for the bot to log in and join its channels
+startup_timeout = 30
+
+# Stats line counting the chat messages the bot has handled
+handled_metric = "foundationalbot_lines_by_command_total{command=\"PRIVMSG\"}"
+
+
+### BOT PROCESS ###
+
+def loadtest_bot_main(port, metrics_port, channels, log_level, db_file):
+    """ Entry point of the bot's process. Settings that would reach outside the test are overridden. """
+    # The test handles interrupts and stops the bot through chat
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot_cfg.host_server = "127.0.0.1"
+    bot_cfg.host_port = port
+    bot_cfg.bot_handle = loadtest_handle
+    bot_cfg.bot_password = "oauth:loadtest"
+    bot_cfg.bot_admin = loadtest_admin
+    bot_cfg.channels = list(channels)
+    bot_cfg.db_file = db_file
+    bot_cfg.metrics_port = metrics_port
+    bot_cfg.log_level = log_level
+    bot_cfg.log_levels = {}
+    bot_cfg.log_file = ""
+    bot_cfg.reload_interval = 0
+    bot_cfg.sfx1_path = bot_cfg.sfx2_path = ""
+    fb_log.log_setup()
+    try:
+        asyncio.run(foundationalbot.bot_main())
+    finally:
+        fb_log.log_shutdown()
+
+
+### HELPER FUNCTIONS ###
+
+def _free_port():
+    """ A local port nothing is listening on """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+async def _messages_handled(metrics_port):
+    """ Chat messages the bot has handled, read from its stats endpoint. None if it cannot be reached. """
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", metrics_port)
+    except OSError:
+        return None
+    try:
+        writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = await asyncio.wait_for(reader.read(), 5)
+    except (asyncio.TimeoutError, ConnectionError):
+        return None
+    finally:
+        writer.close()
+
+    for line in response.decode("utf-8", "replace").splitlines():
+        if line.startswith(handled_metric):
+            return int(float(line.rsplit(" ", 1)[1]))
+    return 0
+
+class HandledSamples:
+    """ The bot's count of handled chat messages, read every stats_interval seconds """
+
+    def __init__(self, metrics_port):
+        self.metrics_port = metrics_port
+        # (time, messages handled)
+        self.samples = []
+
+    async def collect(self):
+        while True:
+            handled = await _messages_handled(self.metrics_port)
+            if handled is not None:
+                self.samples.append((monotonic(), handled))
+            await asyncio.sleep(stats_interval)
+
+    def latest(self):
+        return self.samples[-1][1] if self.samples else 0
+
+    def reached(self, count):
+        """ Time of the first read at or past count, or of the last read if none got there """
+        for sample_time, handled in self.samples:
+            if handled >= count:
+                return sample_time
+        return self.samples[-1][0] if self.samples else monotonic()
+
+    def peak_rate(self):
+        """ Most messages handled per second between two reads a second or more apart """
+        peak = 0.0
+        for index, (end_time, end_count) in enumerate(self.samples):
+            for start_time, start_count in reversed(self.samples[:index]):
+                if end_time - start_time >= 1:
+                    peak = max(peak, (end_count - start_count) / (end_time - start_time))
+                    break
+
+        return peak
+
+
+### LOAD TEST ###
+
+async def loadtest(arguments):
+    """ Run the bot against generated traffic and report how it kept up. Returns True if it did. """
+    record_file = open(arguments.record, "w", encoding="utf-8") if arguments.record else None
+    server = fb_tmi.FakeTMIServer(not arguments.not_mod, record_file)
+    port = await server.start("127.0.0.1", 0)
+    metrics_port = _free_port()
+    # Spawned rather than forked so the bot starts as it would on its own
+    bot_process = mp.get_context("spawn").Process(
+        target=loadtest_bot_main,
+        args=(port, metrics_port, arguments.channels, arguments.log_level, arguments.db),
+        name="foundationalbot-loadtest"
+        )
+    bot_process.start()
+    handled = HandledSamples(metrics_port)
+    sampler = None
+
+    try:
+        deadline = monotonic() + startup_timeout
+        while not server.joined(arguments.channels):
+            if not bot_process.is_alive() or monotonic() > deadline:
+                print("The bot did not log in and join its channels.")
+                return False
+            await asyncio.sleep(0.1)
+        # Let the bot take in its join replies before the burst
+        await asyncio.sleep(1)
+
+        sampler = asyncio.ensure_future(handled.collect())
+        print(f"Sending {arguments.rate:g} lines per second from {arguments.users} viewers for {arguments.duration:g} seconds...")
+        start = monotonic()
+        generated = await fb_tmi.tmi_traffic(
+            server, arguments.channels, arguments.rate, arguments.users, arguments.duration, arguments.violations,
+            ping_interval=arguments.ping_interval, reconnect_after=arguments.reconnect_after,
+            mode_interval=arguments.mode_interval, userstate_interval=arguments.userstate_interval, seed=arguments.seed
+            )
+        traffic_end = monotonic()
+        backlog = server.messages_delivered - handled.latest()
+
+        # Wait for the bot to work through what it was sent
+        while handled.latest() < server.messages_delivered and monotonic() - traffic_end < arguments.drain_timeout:
+            await asyncio.sleep(stats_interval)
+        delivered = server.messages_delivered
+        caught_up = handled.latest() >= delivered
+        finish = handled.reached(delivered)
+        # Give answers to the last rule breaking messages a moment to arrive
+        await asyncio.sleep(1)
+        summary = server.summary()
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        # Stop the bot as its administrator would
+        for channel in arguments.channels[:1]:
+            server.chat(channel, loadtest_admin, "!quit")
+        await asyncio.sleep(0.5)
+        await asyncio.get_event_loop().run_in_executor(None, bot_process.join, 10)
+        if bot_process.is_alive():
+            bot_process.terminate()
+        await server.close()
+        if record_file is not None:
+            record_file.close()
+
+    sent_seconds = traffic_end - start
+    handled_seconds = max(finish - start, sent_seconds)
+    print(f"Generated {generated} lines in {sent_seconds:.1f}s ({generated / sent_seconds:.0f}/s)")
+    print(
+        f"Chat messages handled: {min(handled.latest(), delivered)} of {delivered} in {handled_seconds:.1f}s "
+        f"({min(handled.latest(), delivered) / handled_seconds:.0f}/s, peak {handled.peak_rate():.0f}/s)"
+        )
+    print(f"Behind when the traffic stopped: {max(backlog, 0)} messages" + ( "" if caught_up else "; never caught up" ))
+    print("\n".join(summary))
+
+    return caught_up and not any(server.window_violations.values())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake of Twitch's chat server.")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic (default: 30)")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for the bot to catch up (default: 60)")
+    parser.add_argument("--log-level", default="WARNING", help="bot's log level (default: WARNING)")
+    parser.add_argument("--db", default=":memory:", help="bot's database file (default: :memory:)")
+    fb_tmi.tmi_arguments(parser)
+    passed = asyncio.run(loadtest(parser.parse_args()))
+    raise SystemExit(0 if passed else 1)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_log.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_log.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_log.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_log.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Each subsystem logs through its own logger under "foundationalbot"
+# (foundationalbot.irc, .sql, .moderation, .commands, .chat, ...). Records are
+# put on a bounded queue and formatted and written by a background thread, so a
+# slow terminal, pipe or disk never holds up message processing. Messages are
+# given as a format string plus arguments, which are only merged if the record
+# is actually written.
+
+# Core Modules
+import logging                  # Python's logging module
+import logging.handlers         # Queue and rotating file handlers
+import queue                    # Queue between the bot and the writer thread
+import sys                      # Standard output
+# Project Modules
+import bot_cfg                  # Bot's config file
+
+### LOGGING VARIABLES ###
+
+# Parent of every subsystem logger
+log_root_name = "foundationalbot"
+log_format = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+log_date_format = "%Y%m%d %H:%M:%S"
+
+# Records waiting for the writer thread. Records arriving while it is full are dropped and counted.
+log_queue_size = 10000
+log_dropped = 0
+
+# Background writer while logging is running
+log_listener = None
+
+
+### QUEUE HANDLER ###
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler that drops records instead of blocking or raising when the queue is full. """
+
+    def prepare(self, record):
+        # Formatting is left to the writer thread
+        return record
+
+    def enqueue(self, record):
+        global log_dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped += 1
+
+
+### SETUP ###
+
+def get_logger(subsystem):
+    """ Return the logger of a subsystem, such as "irc" or "sql". """
+    return logging.getLogger(f"{log_root_name}.{subsystem}")
+
+def log_setup(log_file=None):
+    """ Start the background writer and route every subsystem logger through it. """
+    global log_listener
+    if log_file is None:
+        log_file = bot_cfg.log_file
+
+    formatter = logging.Formatter(log_format, log_date_format)
+    output_handlers = [ logging.StreamHandler(sys.stdout) ]
+    if log_file:
+        output_handlers.append(
+            logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=bot_cfg.log_file_size, backupCount=bot_cfg.log_file_count, encoding="utf-8"
+                )
+            )
+    for handler in output_handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(log_queue_size)
+    log_listener = logging.handlers.QueueListener(log_queue, *output_handlers)
+    log_listener.start()
+
+    root_logger = logging.getLogger(log_root_name)
+    root_logger.handlers[:] = [ DroppingQueueHandler(log_queue) ]
+    root_logger.propagate = False
+    log_levels_apply()
+
+def log_levels_apply():
+    """ Set the log levels from bot_cfg, clearing subsystem levels no longer listed. """
+    root_logger = logging.getLogger(log_root_name)
+    root_logger.setLevel(bot_cfg.log_level)
+    for name, subsystem_logger in list(logging.Logger.manager.loggerDict.items()):
+        if name.startswith(f"{log_root_name}.") and isinstance(subsystem_logger, logging.Logger):
+            subsystem_logger.setLevel(logging.NOTSET)
+    for subsystem, level in bot_cfg.log_levels.items():
+        get_logger(subsystem).setLevel(level)
+
+def log_shutdown():
+    """ Write out queued records and stop the background writer. """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+    if log_dropped:
+        print(f"{log_dropped} log records were dropped while the log queue was full.", file=sys.stderr)
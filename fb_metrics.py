@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_metrics.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_metrics.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_metrics.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_metrics.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Counters, gauges and per-stage latency histograms for the bot. They are read
+# through the admin !stats command, or scraped in Prometheus text format from
+# http://127.0.0.1:<bot_cfg.metrics_port>/metrics when the port is set.
+
+# Core Modules
+import asyncio                  # Stats endpoint
+from bisect import bisect_left  # Histogram bucket lookup
+from time import perf_counter   # Stage timing
+# Project Modules
+import bot_cfg                  # Bot's config file
+
+### METRICS VARIABLES ###
+
+# Prefix of every exported metric name
+metrics_prefix = "foundationalbot"
+
+# Dictionary of counter name:(help text, label name or None)
+counter_definitions = {
+    "connections": ("Connection attempts by outcome.", "outcome"),
+    "lines_received": ("Lines received from the server.", None),
+    "lines_by_command": ("Lines received by IRC command.", "command"),
+    "lines_dropped": ("Received lines discarded without being handled.", "reason"),
+    "lines_sent": ("Lines sent to the server by IRC command.", "command"),
+    "strikes": ("Strikes handed out by chat moderation.", None),
+    "timeouts": ("Timeouts handed out by chat moderation.", None),
+    "bans": ("Bans handed out by chat moderation.", None),
+    "moderation_hits": ("Messages caught by each moderation rule.", "rule"),
+    "pool_waits": ("Jobs that waited for room in a full background pool.", "pool"),
+    }
+# Dictionary of (counter name, label value or None):count
+metrics_counters = {}
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = ( 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+# Dictionary of stage:LatencyHistogram. Stages of handling a received line:
+#   line: the whole line, parse: tokenizing, database: viewer lookups and updates,
+#   commands: the command parser, moderation: the moderation rules, with
+#   rule_<name> for each rule
+# and of sending:
+#   send_wait: time a line waited in the send lanes, including rate limit delays
+metrics_latency = {}
+
+# Dictionary of gauge name:(help text, function returning the current value)
+metrics_gauges = {}
+
+
+### COLLECTION ###
+
+class LatencyHistogram:
+    """ Counts of observed durations per latency bucket, plus their total. """
+    __slots__ = ("bucket_counts", "count", "total")
+
+    def __init__(self):
+        # One count per bucket, plus one for durations beyond the last bucket
+        self.bucket_counts = [0] * (len(latency_buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect_left(latency_buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of observations. None if empty or beyond the last bucket. """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket, bucket_count in zip(latency_buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket
+        return None
+
+def metrics_count(name, label=None, amount=1):
+    """ Add to a counter, such as metrics_count("lines_by_command", "PRIVMSG"). """
+    key = (name, label)
+    metrics_counters[key] = metrics_counters.get(key, 0) + amount
+
+def metrics_counter_total(name):
+    """ Sum of a counter across all of its labels. """
+    return sum(count for (counter, label), count in metrics_counters.items() if counter == name)
+
+def metrics_observe(stage, seconds):
+    """ Record the duration of one pass through a stage. """
+    histogram = metrics_latency.get(stage)
+    if histogram is None:
+        histogram = metrics_latency[stage] = LatencyHistogram()
+    histogram.observe(seconds)
+
+def metrics_gauge(name, help_text, function):
+    """ Register a gauge read by calling function when metrics are reported. """
+    metrics_gauges[name] = (help_text, function)
+
+class stage_timer:
+    """ Time a block of code as a stage: with fb_metrics.stage_timer("parse"): ... """
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics_observe(self.stage, perf_counter() - self.start)
+
+
+### REPORTING ###
+
+def _label_value(value):
+    """ Escape a label value for the Prometheus text format. """
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def metrics_render():
+    """ All metrics in Prometheus text exposition format. """
+    lines = []
+    for name, (help_text, label_name) in counter_definitions.items():
+        metric = f"{metrics_prefix}_{name}_total"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for (counter, label), count in sorted(metrics_counters.items(), key=lambda item: str(item[0])):
+            if counter != name:
+                continue
+            if label_name is None or label is None:
+                lines.append(f"{metric} {count}")
+            else:
+                lines.append(f"{metric}{{{label_name}=\"{_label_value(label)}\"}} {count}")
+
+    for name, (help_text, function) in metrics_gauges.items():
+        metric = f"{metrics_prefix}_{name}"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {function()}")
+
+    metric = f"{metrics_prefix}_stage_seconds"
+    lines.append(f"# HELP {metric} Time spent per stage of handling and sending lines.")
+    lines.append(f"# TYPE {metric} histogram")
+    for stage, histogram in sorted(metrics_latency.items()):
+        cumulative = 0
+        for bucket, bucket_count in zip(latency_buckets, histogram.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{{stage=\"{stage}\",le=\"{bucket}\"}} {cumulative}")
+        lines.append(f"{metric}_bucket{{stage=\"{stage}\",le=\"+Inf\"}} {histogram.count}")
+        lines.append(f"{metric}_sum{{stage=\"{stage}\"}} {histogram.total}")
+        lines.append(f"{metric}_count{{stage=\"{stage}\"}} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
+
+def metrics_summary():
+    """ Short summary fit for a chat message. """
+    summary = (
+        f"Lines in: {metrics_counter_total('lines_received')} "
+        f"(dropped {metrics_counter_total('lines_dropped')}), "
+        f"out: {metrics_counter_total('lines_sent')}. "
+        f"Strikes: {metrics_counter_total('strikes')}, "
+        f"timeouts: {metrics_counter_total('timeouts')}, "
+        f"bans: {metrics_counter_total('bans')}."
+        )
+    for name, (help_text, function) in metrics_gauges.items():
+        summary += f" {name}: {function()}."
+
+    for stage in ("line", "send_wait"):
+        histogram = metrics_latency.get(stage)
+        if histogram is None or histogram.count == 0:
+            continue
+        p99 = histogram.quantile(0.99)
+        p99_text = f"<= {p99 * 1000:g}ms" if p99 is not None else f"> {latency_buckets[-1]:g}s"
+        summary += f" {stage} avg {histogram.total / histogram.count * 1000:.3f}ms, p99 {p99_text}."
+
+    return summary
+
+
+### STATS ENDPOINT ###
+
+async def _metrics_request(reader, writer):
+    """ Answer one HTTP request with the metrics. """
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+        if path in (b"/", b"/metrics"):
+            status = "200 OK"
+            body = metrics_render().encode("utf-8")
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+        writer.write(
+            ( f"HTTP/1.0 {status}\r\n"
+              "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+              f"Content-Length: {len(body)}\r\n"
+              "Connection: close\r\n\r\n" ).encode("utf-8") + body
+            )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def metrics_serve():
+    """ Start the stats endpoint on localhost. Returns the server, or None if disabled. """
+    if not bot_cfg.metrics_port:
+        return None
+    return await asyncio.start_server(_metrics_request, "127.0.0.1", bot_cfg.metrics_port)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_moderation.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_moderation.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_moderation.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_moderation.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Chat moderation rules. Each rule registers with an estimated cost and the
+# rules run cheapest first, stopping at the first one broken, so every message
+# gets at most one verdict and the expensive scans only run on messages the
+# cheap checks let through. Hits and time spent are counted per rule.
+
+# Core Modules
+import re                       # Link detection
+from bisect import insort       # Rules kept in cost order
+from time import perf_counter   # Rule timing
+# Project Modules
+import bot_cfg                  # Bot's config file
+import fb_blocklist             # Blocked web address domains
+import fb_flood                 # Flood detection
+import fb_metrics               # Rule counters
+import fb_watchlist             # Compiled language watchlist
+
+### RULE REGISTRY ###
+
+# Rules in the order they run, cheapest first
+moderation_rules = []
+
+class ModerationRule:
+    """ A moderation rule: its check and estimated cost. """
+    __slots__ = ("name", "cost", "check")
+
+    def __init__(self, name, cost, check):
+        self.name = name
+        self.cost = cost
+        self.check = check
+
+    def __lt__(self, other):
+        return self.cost < other.cost
+
+def rule(name, cost):
+    """ Register the decorated function as a moderation rule.
+
+    The function is called as check(channel, username, message) and returns a
+    reason the message breaks the rule, or None if it does not. Rules with
+    lower costs run first.
+    """
+    def register(check):
+        insort(moderation_rules, ModerationRule(name, cost, check))
+        return check
+
+    return register
+
+def moderation_check(channel, username, message):
+    """ Run the rules on a message. Returns (rule name, reason) for the first rule broken, or None. """
+    for moderation_rule in moderation_rules:
+        start = perf_counter()
+        reason = moderation_rule.check(channel, username, message)
+        fb_metrics.metrics_observe(f"rule_{moderation_rule.name}", perf_counter() - start)
+        if reason is not None:
+            fb_metrics.metrics_count("moderation_hits", moderation_rule.name)
+            return moderation_rule.name, reason
+
+    return None
+
+
+### RULES ###
+
+@rule("length", cost=1)
+def rule_length(channel, username, message):
+    """ Messages longer than bot_cfg.moderation_max_length """
+    if bot_cfg.moderation_max_length and len(message) > bot_cfg.moderation_max_length:
+        return "message too long"
+    return None
+
+@rule("flood", cost=0)
+def rule_flood(channel, username, message):
+    """ Fast senders and many copies of one message. Runs first so every message is counted. """
+    flood = fb_flood.flood_check(channel, username, message)
+    if flood == fb_flood.FLOOD_RATE:
+        return "sending messages too quickly"
+    elif flood == fb_flood.FLOOD_DUPLICATE:
+        return "repeating a message flooding chat"
+    return None
+
+@rule("caps", cost=3)
+def rule_caps(channel, username, message):
+    """ Long messages mostly in capital letters """
+    if len(message) < bot_cfg.uppercase_message_suppress_length:
+        return None
+    uppercase = sum(map(str.isupper, message))
+    if uppercase == 0:
+        return None
+    lowercase = sum(map(str.islower, message))
+    if uppercase / (uppercase + lowercase) >= bot_cfg.uppercase_ratio:
+        return "message in all capitals"
+    return None
+
+# Anything that looks like a web address: a scheme, or a dotted name ending in a top-level domain
+link_pattern = re.compile(r"(?:https?://|www\.)\S+|\b[\w-]+(?:\.[\w-]+)*\.[a-z]{2,}\b", re.IGNORECASE)
+
+@rule("links", cost=5)
+def rule_links(channel, username, message):
+    """ Any web address, when bot_cfg.moderation_allow_links is off """
+    if not bot_cfg.moderation_allow_links and link_pattern.search(message):
+        return "posting a link"
+    return None
+
+@rule("blocklist", cost=6)
+def rule_blocklist(channel, username, message):
+    """ Links to blocked domains """
+    blocked = fb_blocklist.blocklist_match(message)
+    if blocked is not None:
+        return f"linking to a blocked address ({blocked})"
+    return None
+
+@rule("watchlist", cost=10)
+def rule_watchlist(channel, username, message):
+    """ Entries on the language watchlist """
+    match = fb_watchlist.watchlist_first(message)
+    if match is not None:
+        return f"violating the language watchlist ({match})"
+    return None
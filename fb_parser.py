@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_parser.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_parser.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_parser.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_parser.py. If not, see <http://www.gnu.org/licenses/>.
+
+# IRC line layout, with IRCv3 message tags as sent by Twitch:
+#   [@tags ][:prefix ]COMMAND[ params...][ :trailing]
+# A line is split left to right once. Tags are kept as a raw string until
+# something asks for them, since most lines never look at their tags.
+
+### PARSING VARIABLES ###
+
+# IRCv3 tag value escapes
+tag_value_escapes = { ":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n" }
+
+
+### HELPER FUNCTIONS ###
+
+def _unescape_tag_value(value):
+    """ Undo IRCv3 tag value escaping. """
+    if "\\" not in value:
+        return value
+
+    unescaped = []
+    escaped = False
+    for character in value:
+        if escaped:
+            unescaped.append(tag_value_escapes.get(character, character))
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        else:
+            unescaped.append(character)
+
+    return "".join(unescaped)
+
+def _parse_tags(tags_raw):
+    """ Split a raw tag string into a dictionary of tag:value. """
+    tags = {}
+    for tag in tags_raw.split(";"):
+        key, separator, value = tag.partition("=")
+        tags[key] = _unescape_tag_value(value)
+
+    return tags
+
+
+### IRC MESSAGE ###
+
+class IRCMessage:
+    """ A single parsed line from the IRC server. """
+    __slots__ = ("raw", "prefix", "command", "params", "trailing", "_tags_raw", "_tags")
+
+    def __init__(self, raw, tags_raw, prefix, command, params, trailing):
+        self.raw = raw
+        self._tags_raw = tags_raw
+        self._tags = None
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+    @property
+    def tags(self):
+        """ Message tags as a dictionary, parsed on first access. """
+        if self._tags is None:
+            self._tags = _parse_tags(self._tags_raw) if self._tags_raw else {}
+        return self._tags
+
+    @property
+    def nick(self):
+        """ Nickname portion of the prefix (nick!user@host). """
+        if self.prefix is None:
+            return None
+        return self.prefix.split("!", 1)[0]
+
+    @property
+    def channel(self):
+        """ First parameter when it names a channel. """
+        if self.params and self.params[0].startswith("#"):
+            return self.params[0]
+        return None
+
+    def __repr__(self):
+        return f"IRCMessage({self.raw!r})"
+
+
+def parse_irc_line(line):
+    """ Parse one IRC line into an IRCMessage. Returns None for an empty line. """
+    tags_raw = None
+    prefix = None
+    trailing = None
+    position = 0
+
+    # Tags
+    if line.startswith("@"):
+        position = line.find(" ")
+        if position == -1:
+            return None
+        tags_raw = line[1:position]
+        position += 1
+
+    # Prefix
+    if line.startswith(":", position):
+        end = line.find(" ", position)
+        if end == -1:
+            return None
+        prefix = line[position + 1:end]
+        position = end + 1
+
+    # Trailing parameter
+    end = line.find(" :", position)
+    if end != -1:
+        trailing = line[end + 2:]
+        middle = line[position:end]
+    else:
+        middle = line[position:]
+
+    # Command and middle parameters
+    params = middle.split()
+    if not params:
+        return None
+    command = params.pop(0).upper()
+
+    return IRCMessage(line, tags_raw, prefix, command, params, trailing)
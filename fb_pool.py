@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_pool.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_pool.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_pool.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_pool.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Pools running blocking work away from the event loop, so reading, PING
+# replies and message handling carry on while it runs:
+#   io:  threads for work that waits on the system, such as starting the
+#        sound effect player, reading changed settings files and committing
+#        the database
+#   cpu: processes for long computations, such as rebuilding a large domain
+#        blocklist. Without bot_cfg.pool_processes, cpu work runs on the io
+#        threads instead.
+# Each pool takes at most bot_cfg.pool_queue_size jobs at once. Further jobs
+# wait for room rather than piling up.
+
+# Core Modules
+import asyncio                  # Futures and waiting for room
+import multiprocessing as mp    # Process start method
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor  # The pools
+# Project Modules
+import bot_cfg                  # Bot's config file
+import fb_log                   # Logging
+import fb_metrics               # Queue depth gauges
+
+logger = fb_log.get_logger("pool")
+
+### POOL VARIABLES ###
+
+# Pool names
+POOL_IO = "io"
+POOL_CPU = "cpu"
+
+# Dictionary of pool name:executor, started on first use
+pool_executors = {}
+# Dictionary of pool name:jobs submitted and not yet finished
+pool_pending = { POOL_IO: 0, POOL_CPU: 0 }
+# Dictionary of pool name:event set when a job finishes, for jobs waiting for room
+pool_room = {}
+
+
+### HELPER FUNCTIONS ###
+
+def _pool_executor(pool):
+    """ Executor of a pool, started if need be """
+    executor = pool_executors.get(pool)
+    if executor is not None:
+        return executor
+
+    if pool == POOL_CPU and bot_cfg.pool_processes > 0:
+        # Supervisor workers are daemon processes, which may not start processes of their own
+        if mp.current_process().daemon:
+            logger.info("Running cpu pool jobs in threads; processes cannot be started from a supervisor worker.")
+        else:
+            # Spawned rather than forked: the bot's threads are not copied into the children
+            executor = ProcessPoolExecutor(bot_cfg.pool_processes, mp_context=mp.get_context("spawn"))
+    if executor is None:
+        executor = ThreadPoolExecutor(bot_cfg.pool_threads, thread_name_prefix=f"fb-pool-{pool}")
+
+    pool_executors[pool] = executor
+    return executor
+
+def _pool_done(pool, future):
+    """ Count a finished job and wake jobs waiting for room """
+    pool_pending[pool] -= 1
+    room = pool_room.get(pool)
+    if room is not None:
+        room.set()
+
+
+### RUNNING JOBS ###
+
+async def pool_run(pool, function, *args):
+    """ Run function(*args) in a pool and return its result, waiting for room in the pool first. """
+    while pool_pending[pool] >= bot_cfg.pool_queue_size:
+        fb_metrics.metrics_count("pool_waits", pool)
+        room = pool_room.get(pool)
+        if room is None:
+            room = pool_room[pool] = asyncio.Event()
+        room.clear()
+        await room.wait()
+
+    future = asyncio.get_running_loop().run_in_executor(_pool_executor(pool), function, *args)
+    pool_pending[pool] += 1
+    future.add_done_callback(lambda finished: _pool_done(pool, finished))
+
+    return await future
+
+def pool_shutdown():
+    """ Finish running jobs and stop the pools. They start again on next use. """
+    for executor in pool_executors.values():
+        executor.shutdown(wait=True)
+    pool_executors.clear()
+    pool_room.clear()
+
+fb_metrics.metrics_gauge("pool_io_pending", "Jobs running or queued in the io pool.", lambda: pool_pending[POOL_IO])
+fb_metrics.metrics_gauge("pool_cpu_pending", "Jobs running or queued in the cpu pool.", lambda: pool_pending[POOL_CPU])
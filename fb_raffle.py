@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_raffle.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_raffle.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_raffle.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_raffle.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Raffle entrants are kept in memory per channel as a list plus a
+# username:position index. Entering, leaving, counting and drawing a winner
+# are all constant time; leaving swaps the last entrant into the freed slot.
+# Changes are written to the Raffle column of the Viewers table in batches by
+# raffle_persist().
+
+# Project Modules
+import config               # Variables shared between modules
+import fb_common            # Shared functions across modules
+import fb_sql               # SQLite database interaction
+
+### RAFFLE VARIABLES ###
+
+# Dictionary of channel:list of entrants
+raffle_entrants = {}
+# Dictionary of channel:dictionary of entrant:position in the entrant list
+raffle_positions = {}
+# Dictionary of channel:dictionary of username:raffle value (0/1) not yet written to the database
+raffle_pending = {}
+
+
+### HELPER FUNCTIONS ###
+
+def _raffle_load(channel):
+    """ Return the entrant list and index of a channel, loading entrants from the database once. """
+    if channel not in raffle_entrants:
+        entrants = [ row[0] for row in fb_sql.db_vt_show_all_raffle(channel) ]
+        raffle_entrants[channel] = entrants
+        raffle_positions[channel] = { user: position for position, user in enumerate(entrants) }
+
+    return raffle_entrants[channel], raffle_positions[channel]
+
+def _raffle_remove(channel, user):
+    """ Remove an entrant by moving the last entrant into its place. """
+    entrants, positions = _raffle_load(channel)
+    position = positions.pop(user)
+    last_entrant = entrants.pop()
+    if last_entrant != user:
+        entrants[position] = last_entrant
+        positions[last_entrant] = position
+    raffle_pending.setdefault(channel, {})[user] = 0
+
+
+### RAFFLE ACTIONS ###
+
+def raffle_enter(channel, user):
+    """ Add a viewer to a channel's raffle. Returns True if newly entered. """
+    entrants, positions = _raffle_load(channel)
+    if user in positions:
+        return False
+
+    positions[user] = len(entrants)
+    entrants.append(user)
+    raffle_pending.setdefault(channel, {})[user] = 1
+
+    return True
+
+def raffle_count(channel):
+    """ Number of entrants in a channel's raffle. """
+    return len(_raffle_load(channel)[0])
+
+def raffle_draw_winner(channel):
+    """ Pick a winner uniformly at random and remove them from the pool. Returns (winner, entrant count) or None. """
+    entrants, positions = _raffle_load(channel)
+    entrant_count = len(entrants)
+    if entrant_count == 0:
+        return None
+
+    winner = entrants[fb_common.generate_number(0, entrant_count - 1)]
+    # Only allow winner to win once per raffle
+    _raffle_remove(channel, winner)
+
+    return winner, entrant_count
+
+def raffle_open(channel, keyword):
+    """ Start a new raffle watching chat for the keyword. """
+    raffle_reset(channel)
+    config.raffle_keyword[channel] = keyword
+    config.raffle_active[channel] = True
+
+def raffle_reset(channel):
+    """ Remove every entrant and forget the raffle's settings. """
+    raffle_entrants[channel] = []
+    raffle_positions[channel] = {}
+    raffle_pending.pop(channel, None)
+    config.raffle_keyword.pop(channel, None)
+    config.raffle_active[channel] = False
+    fb_sql.db_vt_reset_all_raffle(channel)
+
+def raffle_check_message(channel, user, message):
+    """ Enter a viewer whose chat message is the keyword of an open raffle. Returns True if entered. """
+    if not config.raffle_active.get(channel, False):
+        return False
+    if message.strip() != config.raffle_keyword.get(channel):
+        return False
+
+    return raffle_enter(channel, user)
+
+def raffle_persist():
+    """ Write raffle entries and removals to the database in one batch per channel. """
+    for channel, changes in raffle_pending.items():
+        fb_sql.db_vt_change_raffle_many(channel, changes.items())
+    raffle_pending.clear()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_reload.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_reload.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_reload.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_reload.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Picks up edits to bot_cfg.py, language_watchlist.py and the blocklist files
+# while the bot runs. The files' modification times are checked every
+# bot_cfg.reload_interval seconds. Changed files are read and the watchlist
+# matcher rebuilt in a pool thread, and the domain table is rebuilt in the cpu
+# pool (fb_pool.py). The results are then swapped in between two messages. A
+# file with errors is reported and the settings in use are kept.
+
+# Core Modules
+import asyncio                  # Periodic checks
+import os                       # File modification times
+# Project Modules
+import bot_cfg                  # Bot's config file
+import fb_blocklist             # Blocked web address domains
+import fb_commands              # Prebuilt command replies
+import fb_log                   # Logging
+import fb_pool                  # Background work pools
+import fb_watchlist             # Compiled language watchlist
+import language_watchlist       # Collection of words to take action on
+
+logger = fb_log.get_logger("reload")
+
+### RELOAD VARIABLES ###
+
+# Settings only read at start up; changing them takes a restart
+reload_fixed_settings = {
+    "host_server", "host_port", "bot_handle", "bot_password", "channels",
+    "log_file", "log_file_size", "log_file_count", "metrics_port", "db_file",
+    "supervisor_workers", "supervisor_channels_file", "pool_threads", "pool_processes",
+    "vlc_bin", "sfx_player_port", "sfx_player_command", "sfx1_alias", "sfx2_alias",
+    }
+
+# Dictionary of file path:modification time when last read
+reload_mtimes = {}
+
+
+### HELPER FUNCTIONS ###
+
+def _mtime(path):
+    """ Modification time of a file, or None if it cannot be read. """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _watched_files():
+    return [ bot_cfg.__file__, language_watchlist.__file__, *bot_cfg.blocklist_files ]
+
+def _changed_files():
+    """ Files modified since they were last read """
+    changed = set()
+    for path in _watched_files():
+        mtime = _mtime(path)
+        if reload_mtimes.get(path) != mtime:
+            reload_mtimes[path] = mtime
+            changed.add(path)
+
+    return changed
+
+def _read_settings(path):
+    """ Run a settings file in its own namespace and return its public names. """
+    with open(path, encoding="utf-8") as settings_file:
+        source = settings_file.read()
+    namespace = {}
+    exec(compile(source, path, "exec"), namespace)
+
+    return { name: value for name, value in namespace.items() if not name.startswith("_") }
+
+
+### BUILDING ###
+# Run in the background pools; nothing here touches state in use
+
+def config_build():
+    """ Read bot_cfg.py. Returns its reloadable settings. """
+    settings = _read_settings(bot_cfg.__file__)
+    return { name: value for name, value in settings.items() if name not in reload_fixed_settings }
+
+def watchlist_build():
+    """ Read language_watchlist.py. Returns the lists and the compiled word matcher. """
+    watchlists = _read_settings(language_watchlist.__file__)
+    return watchlists, fb_watchlist.watchlist_compile(watchlists["prohibited_words"])
+
+
+### APPLYING ###
+# Run on the event loop, between messages
+
+def config_apply(settings):
+    """ Swap in reloaded bot_cfg settings and rebuild what is derived from them. """
+    for name, value in settings.items():
+        setattr(bot_cfg, name, value)
+    fb_log.log_levels_apply()
+    fb_commands.command_static_load()
+
+def watchlist_apply(watchlists, words_matcher, domain_set):
+    """ Swap in a rebuilt watchlist matcher and domain table. """
+    for name, value in watchlists.items():
+        setattr(language_watchlist, name, value)
+    fb_watchlist.prohibited_words_matcher = words_matcher
+    fb_blocklist.blocked_domains = domain_set
+
+async def config_reload():
+    """ Reload whichever watched files changed since the last check. """
+    changed = _changed_files()
+    if not changed:
+        return
+
+    if bot_cfg.__file__ in changed:
+        try:
+            settings = await fb_pool.pool_run(fb_pool.POOL_IO, config_build)
+        except Exception as error:
+            logger.error("Keeping current settings; bot_cfg.py failed to load: %r", error)
+        else:
+            blocklist_files = bot_cfg.blocklist_files
+            config_apply(settings)
+            logger.info("Settings reloaded from bot_cfg.py.")
+            # New blocklist files are loaded below and watched from now on
+            if bot_cfg.blocklist_files != blocklist_files:
+                changed.add(language_watchlist.__file__)
+                for path in bot_cfg.blocklist_files:
+                    reload_mtimes[path] = _mtime(path)
+
+    if changed - { bot_cfg.__file__ }:
+        try:
+            watchlists, words_matcher = await fb_pool.pool_run(fb_pool.POOL_IO, watchlist_build)
+            url_lists = ( watchlists["url_shortener_list"], watchlists["url_lengthener_list"] )
+            domain_set = await fb_pool.pool_run(
+                fb_pool.POOL_CPU, fb_blocklist.blocklist_load, list(bot_cfg.blocklist_files), url_lists
+                )
+        except Exception as error:
+            logger.error("Keeping current watchlists; language_watchlist.py failed to load: %r", error)
+        else:
+            watchlist_apply(watchlists, words_matcher, domain_set)
+            logger.info("Watchlists reloaded: %d blocked domains.", len(domain_set))
+
+async def config_watcher():
+    """ Check the watched files for changes until cancelled """
+    # The files as they are now were loaded at start up
+    _changed_files()
+    while bot_cfg.reload_interval > 0:
+        await asyncio.sleep(bot_cfg.reload_interval)
+        await config_reload()
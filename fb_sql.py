@@ -16,28 +16,290 @@
 # You should have received a copy of the GNU General Public License
 # along with fb_sql.py. If not, see <http://www.gnu.org/licenses/>.
 
+# Viewer data, kept in an SQLite database behind an in-memory cache. Changed
+# cached rows are written and committed in batches on a second connection, the
+# writer, from a pool thread (see foundationalbot.database_committer), which
+# also checkpoints the write-ahead log. The main connection reads, and runs
+# updates of viewers outside the cache and maintenance, each committed at once,
+# so it never holds the database locked between messages. In-memory databases
+# cannot be opened twice, so their batches are written on the main connection.
+
 # Core Modules
+import argparse                         # Maintenance command line
+import csv                              # CSV import and export
+import json                             # JSON Lines import and export
 import sqlite3                          # Python's sqlite module
-# argparse?
+import sys                              # Standard input and output for import and export
+import threading                        # One batch written at a time
+from collections import OrderedDict     # LRU ordering for the viewer cache
+from itertools import islice            # Chunked imports
+from time import monotonic, time        # Timing of batched commits, last seen times
 # Project Modules
-from bot_cfg import strikes_until_ban   # Only need the max strike count
+import bot_cfg                          # Bot's config file
 import config                           # Variables shared between modules
 
+### STORAGE SETTINGS ###
+
+# Pragmas applied to on-disk databases. WAL lets readers run while the bot writes.
+db_file_pragmas = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA cache_size = -16000",       # 16MB of page cache
+    "PRAGMA mmap_size = 67108864",      # 64MB memory mapped I/O
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    )
+
+# Time of the last batch commit
+db_last_commit = 0.0
+
+# Database file batches are written to on the writer connection; None to write them on the main connection
+db_writer_file = None
+# Connection batches are written on, opened with the first batch so it sees the tables db_vt_createtable set up
+db_writer = None
+# Held while a batch is written
+db_writer_lock = threading.Lock()
+# Batches taken for writing, and the newest batch known written. A batch
+# overtaken by a direct commit of the same rows is skipped.
+db_batch_taken = 0
+db_batch_written = 0
+
+# Statement writing a batch of rows
+db_batch_statement = """INSERT INTO Viewers VALUES (?,?,?,?,?,?,?)
+        ON CONFLICT(Channel, Username) DO UPDATE SET
+            DisplayName = excluded.DisplayName,
+            Strikes = excluded.Strikes,
+            Currency = excluded.Currency,
+            Raffle = excluded.Raffle,
+            LastSeen = excluded.LastSeen"""
+
+# Rows per transaction or fetch of bulk imports and exports
+db_bulk_chunk_size = 5000
+
+### VIEWER CACHE ###
+
+# Rows of the Viewers table held in memory, least recently used first:
+# (channel, username): [DisplayName, Strikes, Currency, Raffle, LastSeen]
+viewer_cache = OrderedDict()
+# Keys of cached rows that have not been written to the database yet
+viewer_cache_dirty = set()
+# Dictionary of (channel, username):row tuple of changed rows waiting for the next batch
+viewer_writes_pending = {}
+# Dictionary of (channel, username):row tuple of the batch being written
+viewer_writes_inflight = {}
+
+# Positions of the columns in a cached row
+CACHE_DISPLAYNAME = 0
+CACHE_STRIKES = 1
+CACHE_CURRENCY = 2
+CACHE_RAFFLE = 3
+CACHE_LASTSEEN = 4
+# Columns making up a cached row, in order
+viewer_columns = "DisplayName, Strikes, Currency, Raffle, LastSeen"
+# Every column of the Viewers table, in order
+viewer_table_columns = ( "Channel", "Username", "DisplayName", "Strikes", "Currency", "Raffle", "LastSeen" )
+
+# LastSeen is a Unix time, only updated once it is this many seconds old
+last_seen_resolution = 3600
+
 ### HELPER FUNCTIONS ###
 
+def _cache_restore(viewer_key):
+    """ Bring back a row that left the cache before it was committed. None if there is none. """
+    pending = viewer_writes_pending.pop(viewer_key, None)
+    if pending is not None:
+        viewer = list(pending)
+        _cache_store(viewer_key, viewer)
+        viewer_cache_dirty.add(viewer_key)
+        return viewer
+
+    inflight = viewer_writes_inflight.get(viewer_key)
+    if inflight is not None:
+        viewer = list(inflight)
+        _cache_store(viewer_key, viewer)
+        return viewer
+
+    return None
+
+def _cache_get(channel, key_value):
+    """ Return the cached row of a viewer, loading it from the database on a miss. None if absent. """
+    viewer_key = (channel, key_value)
+    viewer = viewer_cache.get(viewer_key)
+    if viewer is not None:
+        viewer_cache.move_to_end(viewer_key)
+        return viewer
+    viewer = _cache_restore(viewer_key)
+    if viewer is not None:
+        return viewer
+
+    query_result = config.db_action.execute(
+        f"SELECT {viewer_columns} FROM Viewers WHERE Channel = ? AND Username = ?", viewer_key
+        ).fetchone()
+    if query_result is None:
+        return None
+    viewer = list(query_result)
+    _cache_store(viewer_key, viewer)
+
+    return viewer
+
+def _cache_peek(channel, key_value):
+    """ Return the cached row of a viewer without touching the database. None on a miss. """
+    viewer_key = (channel, key_value)
+    viewer = viewer_cache.get(viewer_key)
+    if viewer is not None:
+        viewer_cache.move_to_end(viewer_key)
+        return viewer
+
+    return _cache_restore(viewer_key)
+
+def _cache_store(viewer_key, viewer):
+    """ Place a row in the cache, evicting the least recently used viewers beyond the size limit. """
+    viewer_cache[viewer_key] = viewer
+    viewer_cache.move_to_end(viewer_key)
+
+    while len(viewer_cache) > bot_cfg.db_cache_size:
+        evicted_key = next(iter(viewer_cache))
+        # Changes wait for the next batch after the row leaves the cache
+        if evicted_key in viewer_cache_dirty:
+            viewer_cache_dirty.discard(evicted_key)
+            viewer_writes_pending[evicted_key] = tuple(viewer_cache[evicted_key])
+        del viewer_cache[evicted_key]
+
+def _cache_mark_dirty(channel, key_value):
+    """ Record a changed row and hand the changes over to the next batch once enough have collected. """
+    viewer_cache_dirty.add((channel, key_value))
+    if len(viewer_cache_dirty) >= bot_cfg.db_flush_size:
+        db_vt_flush()
+
+def _db_write_many(statement, rows):
+    """ Run a statement over many rows in one transaction on the main connection. """
+    config.db_action.execute("BEGIN")
+    try:
+        config.db_action.executemany(statement, rows)
+    except sqlite3.Error:
+        config.db_action.execute("ROLLBACK")
+        raise
+    config.db_action.execute("COMMIT")
+
+def db_vt_flush():
+    """ Hand all changed cached rows over to the next batch. """
+    for viewer_key in viewer_cache_dirty:
+        viewer_writes_pending[viewer_key] = tuple(viewer_cache[viewer_key])
+    viewer_cache_dirty.clear()
+
+def _db_writer_connection():
+    """ Connection batches are written on, opened if need be """
+    global db_writer
+    if db_writer_file is None:
+        return config.db_action.connection
+    if db_writer is None:
+        db_writer = sqlite3.connect( db_writer_file, isolation_level=None, check_same_thread=False )
+        for pragma in db_file_pragmas:
+            db_writer.execute(pragma)
+        db_writer.execute(f"PRAGMA synchronous = {bot_cfg.db_synchronous}")
+
+    return db_writer
+
+def db_batch_write(rows, batch, checkpoint=True):
+    """ Write and commit a batch of rows on the writer connection, then checkpoint the log. Runs in a pool thread. """
+    global db_batch_written
+    with db_writer_lock:
+        # Already written by db_commit
+        if batch <= db_batch_written or not rows:
+            return
+        connection = _db_writer_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(db_batch_statement, rows)
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        db_batch_written = batch
+        if checkpoint and db_writer_file is not None:
+            connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+def db_commit():
+    """ Write and commit every changed row now, after any batch being written. """
+    global db_batch_taken, db_last_commit
+    db_vt_flush()
+    # Rows of a batch still being written go along, overridden by newer changes
+    rows = { **viewer_writes_inflight, **viewer_writes_pending }
+    viewer_writes_inflight.clear()
+    viewer_writes_pending.clear()
+    db_batch_taken += 1
+    db_batch_write([ (*viewer_key, *viewer) for viewer_key, viewer in rows.items() ], db_batch_taken, checkpoint=False)
+    db_last_commit = monotonic()
+
+def db_commit_tick():
+    """ Take the changed rows once the batch is old enough or large enough. Call regularly from the main loop.
+
+    Returns (rows, batch) for db_batch_write to commit in a pool thread, and
+    db_commit_finished to be called after, or None when no batch is due. An
+    in-memory database's batch is committed here instead.
+    """
+    global db_batch_taken, db_last_commit
+    if viewer_writes_inflight or not ( viewer_cache_dirty or viewer_writes_pending ):
+        return None
+    if ( len(viewer_cache_dirty) + len(viewer_writes_pending) < bot_cfg.db_commit_writes and
+         monotonic() - db_last_commit < bot_cfg.db_commit_interval ):
+        return None
+
+    if db_writer_file is None:
+        db_commit()
+        return None
+    db_vt_flush()
+    viewer_writes_inflight.update(viewer_writes_pending)
+    viewer_writes_pending.clear()
+    db_batch_taken += 1
+    db_last_commit = monotonic()
+
+    return [ (*viewer_key, *viewer) for viewer_key, viewer in viewer_writes_inflight.items() ], db_batch_taken
+
+def db_commit_finished(committed):
+    """ Forget the batch taken by db_commit_tick, or return its rows to the next one if it failed. """
+    if not committed:
+        for viewer_key, viewer in viewer_writes_inflight.items():
+            viewer_writes_pending.setdefault(viewer_key, viewer)
+    viewer_writes_inflight.clear()
+
 
 ### OPENING AND CLOSING CONNECTIONS ###
 
-def db_initialize(db_name=':memory:'):
+def db_initialize(db_name=None):
     """ Initalize connection to specific database and return connection info. """
-    db_connection = sqlite3.connect( db_name )
+    global db_writer_file, db_writer, db_last_commit
+    if db_name is None:
+        db_name = bot_cfg.db_file
+
+    # Statements commit as they run unless wrapped in BEGIN and COMMIT
+    db_connection = sqlite3.connect( db_name, isolation_level=None )
     config.db_action = db_connection.cursor()
+    db_writer = None
+    if db_name == ":memory:":
+        db_writer_file = None
+    else:
+        for pragma in db_file_pragmas:
+            config.db_action.execute(pragma)
+        config.db_action.execute(f"PRAGMA synchronous = {bot_cfg.db_synchronous}")
+        # The writer checkpoints the log, away from the main connection's thread
+        config.db_action.execute("PRAGMA wal_autocheckpoint = 0")
+        db_writer_file = db_name
+
+    viewer_cache.clear()
+    viewer_cache_dirty.clear()
+    viewer_writes_pending.clear()
+    viewer_writes_inflight.clear()
+    db_last_commit = monotonic()
 
     return db_connection
 
 def db_shutdown(db_connection):
     """ Commit any changes and close database connection. """
-    db_connection.commit()
+    global db_writer
+    db_commit()
+    if db_writer is not None:
+        db_writer.close()
+        db_writer = None
     db_connection.close()
 
 
@@ -51,130 +313,453 @@ def db_vt_createtable():
         Strikes: Internal counter for user's strikes in timeout/ban system
         Currency: Internal counter for user's time spent in channel
         Raffle: Raffle participant
+        LastSeen: Unix time the viewer was last seen in chat, to the hour
     """
+    # Tables from before multiple channel support are keyed on Username alone
+    existing_columns = [ column[1] for column in config.db_action.execute("PRAGMA table_info(Viewers)") ]
+    config.db_action.execute("BEGIN")
+    if existing_columns and "Channel" not in existing_columns:
+        config.db_action.execute("ALTER TABLE Viewers RENAME TO Viewers_single_channel")
+    # Tables from before LastSeen was kept count everyone as seen now
+    elif existing_columns and "LastSeen" not in existing_columns:
+        config.db_action.execute("ALTER TABLE Viewers ADD COLUMN LastSeen INTEGER DEFAULT 0")
+        config.db_action.execute("UPDATE Viewers SET LastSeen = ?", (int(time()),))
+
     # use IF NOT EXISTS to avoid having to test if table exists before creation
     config.db_action.execute( '''CREATE TABLE IF NOT EXISTS Viewers(
-        Username TEXT PRIMARY KEY,
+        Channel TEXT,
+        Username TEXT,
         DisplayName TEXT,
         Strikes INTEGER DEFAULT 0,
         Currency INTEGER DEFAULT 0,
-        Raffle INTEGER DEFAULT 0)
+        Raffle INTEGER DEFAULT 0,
+        LastSeen INTEGER DEFAULT 0,
+        PRIMARY KEY (Channel, Username))
         WITHOUT ROWID''' )
-
-def db_vt_addentry(user, displayname=None):
+    # Partial indexes cover only the few rows raffle draws and strike reviews look for.
+    # Queries must repeat an index's WHERE condition for the planner to use it.
+    config.db_action.execute("CREATE INDEX IF NOT EXISTS Viewers_Raffle ON Viewers(Channel) WHERE Raffle = 1")
+    config.db_action.execute("CREATE INDEX IF NOT EXISTS Viewers_Strikes ON Viewers(Channel, Strikes) WHERE Strikes > 0")
+    config.db_action.execute("CREATE INDEX IF NOT EXISTS Viewers_Strikes_All ON Viewers(Strikes) WHERE Strikes > 0")
+
+    # Viewers of the old table belonged to the first configured channel
+    if existing_columns and "Channel" not in existing_columns:
+        config.db_action.execute(
+            """INSERT INTO Viewers (Channel, Username, DisplayName, Strikes, Currency, Raffle, LastSeen)
+            SELECT ?, *, ? FROM Viewers_single_channel""", (bot_cfg.channels[0], int(time()))
+            )
+        config.db_action.execute("DROP TABLE Viewers_single_channel")
+    config.db_action.execute("COMMIT")
+
+def db_vt_addentry(channel, user, displayname=None):
     """ Add a new row to the Viewers table. """
-    # TODO: able to mix default and non-default values?
-    config.db_action.execute("INSERT INTO Viewers VALUES (?,?,0,0,0)", (user, displayname))
+    _cache_store((channel, user), [displayname, 0, 0, 0, int(time())])
+    _cache_mark_dirty(channel, user)
+
+def db_vt_upsert_viewer(channel, user, displayname=None):
+    """ Add a viewer if not present, otherwise update their DisplayName when one is given. """
+    now = int(time())
+    viewer = _cache_get(channel, user)
+    if viewer is None:
+        db_vt_addentry(channel, user, displayname)
+        return
+
+    changed = False
+    if displayname is not None and viewer[CACHE_DISPLAYNAME] != displayname:
+        viewer[CACHE_DISPLAYNAME] = displayname
+        changed = True
+    if now - viewer[CACHE_LASTSEEN] >= last_seen_resolution:
+        viewer[CACHE_LASTSEEN] = now
+        changed = True
+    if changed:
+        _cache_mark_dirty(channel, user)
+
+def db_vt_upsert_viewers(channel, viewers):
+    """ Upsert many viewers of a channel at once from a list of (username, displayname) pairs. """
+    now = int(time())
+    uncached_viewers = []
+    for user, displayname in viewers:
+        if _cache_peek(channel, user) is not None:
+            db_vt_upsert_viewer(channel, user, displayname)
+        else:
+            uncached_viewers.append((channel, user, displayname, now))
+    if not uncached_viewers:
+        return
+
+    _db_write_many(
+        """INSERT INTO Viewers (Channel, Username, DisplayName, LastSeen) VALUES (?,?,?,?)
+        ON CONFLICT(Channel, Username) DO UPDATE SET
+            DisplayName = COALESCE(excluded.DisplayName, DisplayName),
+            LastSeen = excluded.LastSeen""",
+        uncached_viewers
+        )
 
 
 ### DB QUERIES ###
-def db_vt_test_username(key_value):
+def db_vt_test_username(channel, key_value):
     """ Query viewer's username to see if present in table. Returns true/false. """
-    query_result = config.db_action.execute("SELECT Username FROM Viewers WHERE Username = ?", (key_value,)).fetchall()
-    if len(query_result) > 0:
-        return True
-    else:
-        return False
+    return _cache_get(channel, key_value) is not None
 
-def db_vt_show_all():
-    """ Query and return the entire Viewers table. """
-    query_result = config.db_action.execute("SELECT * FROM Viewers").fetchall()
+def db_vt_show_all(channel=None):
+    """ Query and return the entire Viewers table, or the viewers of one channel. """
+    db_commit()
+    if channel is None:
+        query_result = config.db_action.execute("SELECT * FROM Viewers").fetchall()
+    else:
+        query_result = config.db_action.execute("SELECT * FROM Viewers WHERE Channel = ?", (channel,)).fetchall()
 
     return query_result
 
-def db_vt_show_all_raffle():
-    """ Query all raffle participants. """
-    query_result = config.db_action.execute("SELECT Username FROM Viewers WHERE Raffle = 1").fetchall()
+def db_vt_show_all_raffle(channel):
+    """ Query all raffle participants of a channel. """
+    db_commit()
+    query_result = config.db_action.execute(
+        "SELECT Username FROM Viewers WHERE Channel = ? AND Raffle = 1", (channel,)
+        ).fetchall()
 
     return query_result
 
-def db_vt_show_displayname(key_value):
+def db_vt_show_displayname(channel, key_value):
     """ Query viewer's chat display name and return it. """
-    query_result = config.db_action.execute("SELECT DisplayName FROM Viewers WHERE Username = ?", (key_value,)).fetchall()
-
-    return query_result[0][0]
+    return _cache_get(channel, key_value)[CACHE_DISPLAYNAME]
 
-def db_vt_show_strikes(key_value):
+def db_vt_show_strikes(channel, key_value):
     """ Query viewer's current strike count and return it. """
-    query_result = config.db_action.execute("SELECT Strikes FROM Viewers WHERE Username = ?", (key_value,)).fetchall()
+    return _cache_get(channel, key_value)[CACHE_STRIKES]
 
-    return query_result[0][0]
-
-def db_vt_show_currency(key_value):
+def db_vt_show_currency(channel, key_value):
     """ Query viewer's current amount of currency and return it. """
-    query_result = config.db_action.execute("SELECT Currency FROM Viewers WHERE Username = ?", (key_value,)).fetchall()
-
-    return query_result[0][0]
+    return _cache_get(channel, key_value)[CACHE_CURRENCY]
 
-def db_vt_show_raffle(key_value):
+def db_vt_show_raffle(channel, key_value):
     """ Query viewer's participation in a raffle. """
-    query_result = config.db_action.execute("SELECT Raffle FROM Viewers WHERE Username = ?", (key_value,)).fetchall()
-
-    if query_result[0][0] == 0:
-        return False
-    elif query_result[0][0] == 1:
-        return True
+    return _cache_get(channel, key_value)[CACHE_RAFFLE] == 1
 
 
 ### CHANGING DB VALUES ###
 
-def db_vt_delete_user(key_value):
+def db_vt_delete_user(channel, key_value):
     """ Delete a row from the Viewers' table """
-    config.db_action.execute("DELETE FROM Viewers WHERE Username = ?", (key_value,))
+    # A batch still being written would bring the row back
+    db_commit()
+    viewer_cache.pop((channel, key_value), None)
+    config.db_action.execute("DELETE FROM Viewers WHERE Channel = ? AND Username = ?", (channel, key_value))
 
-def db_vt_change_displayname(key_value, update_value):
+def db_vt_change_displayname(channel, key_value, update_value):
     """ Update a user's DisplayName. """
-    # if WHERE fails to match any rows, then no rows are updated - does not error
-    config.db_action.execute("UPDATE 'Viewers' SET DisplayName = ? WHERE Username = ?", (update_value, key_value,) )
+    # if the user is unknown no rows are updated - does not error
+    viewer = _cache_get(channel, key_value)
+    if viewer is not None:
+        viewer[CACHE_DISPLAYNAME] = update_value
+        _cache_mark_dirty(channel, key_value)
 
-def db_vt_change_strikes(key_value, strike_value):
+def db_vt_change_strikes(channel, key_value, strike_value):
     """ Change strike count of specified user. """
-    # Update database strike count
-    config.db_action.execute("UPDATE Viewers SET Strikes = ? WHERE Username = ?", (strike_value, key_value,))
-
-def db_vt_change_currency(key_value, increase_amount):
+    viewer = _cache_get(channel, key_value)
+    if viewer is not None:
+        viewer[CACHE_STRIKES] = strike_value
+        _cache_mark_dirty(channel, key_value)
+
+def db_vt_increment_strikes(channel, key_value):
+    """ Add a strike to the specified user and return the new strike count. None if user is unknown. """
+    viewer = _cache_get(channel, key_value)
+    if viewer is None:
+        return None
+    viewer[CACHE_STRIKES] += 1
+    _cache_mark_dirty(channel, key_value)
+
+    return viewer[CACHE_STRIKES]
+
+def db_vt_change_currency(channel, key_value, increase_amount):
     """ Increase a user's currency by the specified value. """
-    currency_count = db_vt_show_currency(key_value) + increase_amount
-
-    # Update database currency value
-    config.db_action.execute("UPDATE Viewers SET Currency = ? WHERE Username = ?", (currency_count, key_value))
-
-def db_vt_change_raffle(key_value):
+    viewer = _cache_get(channel, key_value)
+    if viewer is not None:
+        viewer[CACHE_CURRENCY] += increase_amount
+        _cache_mark_dirty(channel, key_value)
+
+def db_vt_change_currency_many(channel, key_values, increase_amount):
+    """ Increase the currency of every listed user of a channel by the specified value. """
+    uncached_users = []
+    for key_value in key_values:
+        viewer = viewer_cache.get((channel, key_value)) or _cache_restore((channel, key_value))
+        if viewer is not None:
+            viewer[CACHE_CURRENCY] += increase_amount
+            viewer_cache_dirty.add((channel, key_value))
+        else:
+            uncached_users.append((increase_amount, channel, key_value))
+
+    if uncached_users:
+        _db_write_many(
+            "UPDATE Viewers SET Currency = Currency + ? WHERE Channel = ? AND Username = ?", uncached_users
+            )
+    if len(viewer_cache_dirty) >= bot_cfg.db_flush_size:
+        db_vt_flush()
+
+def db_vt_change_raffle(channel, key_value):
     """ Toggle a viewer's raffle participation status. """
-    raffle_participation = db_vt_show_raffle(key_value)
+    viewer = _cache_get(channel, key_value)
+    if viewer is not None:
+        # flip current value to opposite (0 is false, 1 is true)
+        viewer[CACHE_RAFFLE] = 1 - viewer[CACHE_RAFFLE]
+        _cache_mark_dirty(channel, key_value)
+
+def db_vt_change_raffle_many(channel, raffle_values):
+    """ Set the raffle participation of many users of a channel from (username, 0/1) pairs. """
+    uncached_users = []
+    for key_value, raffle_value in raffle_values:
+        viewer = viewer_cache.get((channel, key_value)) or _cache_restore((channel, key_value))
+        if viewer is not None:
+            viewer[CACHE_RAFFLE] = raffle_value
+            viewer_cache_dirty.add((channel, key_value))
+        else:
+            uncached_users.append((raffle_value, channel, key_value))
+
+    if uncached_users:
+        _db_write_many(
+            "UPDATE Viewers SET Raffle = ? WHERE Channel = ? AND Username = ?", uncached_users
+            )
+    if len(viewer_cache_dirty) >= bot_cfg.db_flush_size:
+        db_vt_flush()
+
+def db_vt_enter_raffle(channel, key_value):
+    """ Enter a viewer in the raffle. Returns True if newly entered, False if already in or unknown. """
+    viewer = _cache_get(channel, key_value)
+    if viewer is None or viewer[CACHE_RAFFLE] == 1:
+        return False
+    viewer[CACHE_RAFFLE] = 1
+    _cache_mark_dirty(channel, key_value)
 
-    # flip current value to opposite (0 is false, 1 is true)
-    if raffle_participation == False:
-        config.db_action.execute("UPDATE Viewers SET Raffle = 1 WHERE Username = ?", (key_value,))
-    elif raffle_participation == True:
-        config.db_action.execute("UPDATE Viewers SET Raffle = 0 WHERE Username = ?", (key_value,))
+    return True
 
 
 ### MAINTENANCE ACTIONS ###
 
-def db_vt_resetallcurrency():
-    """ Reset all viewers' currency to 0. """
-    config.db_action.execute("UPDATE Viewers SET Currency = 0")
+def db_vt_resetallcurrency(channel=None):
+    """ Reset all viewers' currency to 0, in every channel or only the given one. """
+    db_commit()
+    if channel is None:
+        config.db_action.execute("UPDATE Viewers SET Currency = 0")
+    else:
+        config.db_action.execute("UPDATE Viewers SET Currency = 0 WHERE Channel = ?", (channel,))
+    for viewer_key, viewer in viewer_cache.items():
+        if channel is None or viewer_key[0] == channel:
+            viewer[CACHE_CURRENCY] = 0
 
 def db_vt_resetviewers():
     """ Globally wipe the Viewer table data. """
+    db_commit()
+    viewer_cache.clear()
     config.db_action.execute("DROP TABLE IF EXISTS Viewers")
 
-def db_vt_reset_all_raffle():
-    """ Reset all viewers' raffle participation. """
-    config.db_action.execute("UPDATE Viewers SET Raffle = 0")
-
-def db_vt_remove_banned_viewers():
-    """ Remove viewers from table that reached the strikecount limit. """
-    config.db_action.execute("DELETE FROM Viewers WHERE Username = ? AND Strikes >= ?", (key_value, strikes_until_ban,))
+def db_vt_reset_all_raffle(channel):
+    """ Reset all viewers' raffle participation in a channel. """
+    db_commit()
+    config.db_action.execute("UPDATE Viewers SET Raffle = 0 WHERE Channel = ?", (channel,))
+    for viewer_key, viewer in viewer_cache.items():
+        if viewer_key[0] == channel:
+            viewer[CACHE_RAFFLE] = 0
+
+def _cache_drop(channel=None):
+    """ Write out and forget cached rows, in every channel or only the given one. """
+    db_commit()
+    if channel is None:
+        viewer_cache.clear()
+        return
+    for viewer_key in [ viewer_key for viewer_key in viewer_cache if viewer_key[0] == channel ]:
+        del viewer_cache[viewer_key]
+
+def db_vt_remove_banned_viewers(channel=None):
+    """ Remove viewers that reached the strikecount limit, in every channel or only the given one. Returns the number removed. """
+    if bot_cfg.strikes_until_ban <= 0:
+        return 0
+    _cache_drop(channel)
+    if channel is None:
+        config.db_action.execute("DELETE FROM Viewers WHERE Strikes > 0 AND Strikes >= ?", (bot_cfg.strikes_until_ban,))
+    else:
+        config.db_action.execute(
+            "DELETE FROM Viewers WHERE Strikes > 0 AND Channel = ? AND Strikes >= ?", (channel, bot_cfg.strikes_until_ban)
+            )
+
+    return config.db_action.rowcount
+
+def db_vt_prune_inactive(days, channel=None):
+    """ Remove viewers not seen in chat for the given number of days. Returns the number removed. """
+    cutoff = int(time()) - days * 86400
+    _cache_drop(channel)
+    if channel is None:
+        config.db_action.execute("DELETE FROM Viewers WHERE LastSeen < ?", (cutoff,))
+    else:
+        config.db_action.execute("DELETE FROM Viewers WHERE Channel = ? AND LastSeen < ?", (channel, cutoff))
+
+    return config.db_action.rowcount
+
+def db_vacuum():
+    """ Commit, fold the write-ahead log into the database and rebuild the file without free pages. """
+    db_commit()
+    config.db_action.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    config.db_action.execute("VACUUM")
+
+def db_analyze():
+    """ Refresh the statistics the query planner uses to pick indexes. """
+    db_commit()
+    config.db_action.execute("ANALYZE")
+    config.db_action.execute("PRAGMA optimize")
+
+def db_reindex():
+    """ Rebuild every index from its table. """
+    db_commit()
+    config.db_action.execute("REINDEX")
+
+
+### BULK IMPORT AND EXPORT ###
+# Rows are streamed through in chunks, so tables of any size use little memory.
+# Formats are CSV with a header row, or JSON Lines with one object per viewer;
+# the file "-" is standard input or output.
+
+def _open_bulk_file(file_name, mode):
+    if file_name == "-":
+        return open(( sys.stdin if mode == "r" else sys.stdout ).fileno(), mode, encoding="utf-8", newline="", closefd=False)
+    return open(file_name, mode, encoding="utf-8", newline="")
+
+def db_vt_export(file_name, file_format="csv", channel=None):
+    """ Write the Viewers table, or one channel of it, to a CSV or JSON Lines file. Returns the number of rows. """
+    db_commit()
+    if channel is None:
+        rows = config.db_action.connection.execute(f"SELECT {', '.join(viewer_table_columns)} FROM Viewers")
+    else:
+        rows = config.db_action.connection.execute(
+            f"SELECT {', '.join(viewer_table_columns)} FROM Viewers WHERE Channel = ?", (channel,)
+            )
+
+    row_count = 0
+    with _open_bulk_file(file_name, "w") as bulk_file:
+        if file_format == "csv":
+            writer = csv.writer(bulk_file)
+            writer.writerow(viewer_table_columns)
+        while True:
+            chunk = rows.fetchmany(db_bulk_chunk_size)
+            if not chunk:
+                break
+            if file_format == "csv":
+                writer.writerows(chunk)
+            else:
+                bulk_file.writelines(
+                    json.dumps(dict(zip(viewer_table_columns, row)), ensure_ascii=False) + "\n" for row in chunk
+                    )
+            row_count += len(chunk)
+
+    return row_count
+
+def _bulk_rows(bulk_file, file_format):
+    """ Yield rows of Viewers table values read from a CSV or JSON Lines file.
+
+    Missing columns take their defaults. Viewers without a LastSeen time count
+    as seen at the import, as they do when the column is first added.
+    """
+    imported_at = int(time())
+    if file_format == "csv":
+        records = csv.DictReader(bulk_file)
+    else:
+        records = ( json.loads(line) for line in bulk_file if line.strip() )
+
+    for record in records:
+        yield (
+            record["Channel"], record["Username"].lower(), record.get("DisplayName") or None,
+            int(record.get("Strikes") or 0), int(record.get("Currency") or 0),
+            int(record.get("Raffle") or 0), int(record.get("LastSeen") or imported_at),
+            )
+
+def db_vt_import(file_name, file_format="csv"):
+    """ Add or replace viewers from a CSV or JSON Lines file, one transaction per chunk. Returns the number of rows. """
+    db_commit()
+    viewer_cache.clear()
+
+    row_count = 0
+    with _open_bulk_file(file_name, "r") as bulk_file:
+        rows = _bulk_rows(bulk_file, file_format)
+        while True:
+            chunk = list(islice(rows, db_bulk_chunk_size))
+            if not chunk:
+                break
+            _db_write_many(
+                f"""INSERT INTO Viewers ({', '.join(viewer_table_columns)}) VALUES (?,?,?,?,?,?,?)
+                ON CONFLICT(Channel, Username) DO UPDATE SET
+                    DisplayName = COALESCE(excluded.DisplayName, DisplayName),
+                    Strikes = excluded.Strikes,
+                    Currency = excluded.Currency,
+                    Raffle = excluded.Raffle,
+                    LastSeen = MAX(excluded.LastSeen, LastSeen)""",
+                chunk
+                )
+            row_count += len(chunk)
+
+    return row_count
 
 
 ### MAIN ###
-if __name__ == "__main__":
-    print("Connection to database...")
-    db_connection = db_initialize()
 
-    # Performance maintenance actions on the database
+def db_maintenance_arguments():
+    """ Command line of the maintenance tool """
+    parser = argparse.ArgumentParser(description="Maintenance of the Foundational IRC Bot's viewer database.")
+    parser.add_argument("--db", default=bot_cfg.db_file, help=f"database file (default: {bot_cfg.db_file})")
+    actions = parser.add_subparsers(dest="action", required=True)
+
+    actions.add_parser("stats", help="show row counts and file size")
+    actions.add_parser("vacuum", help="compact the database file")
+    actions.add_parser("analyze", help="refresh query planner statistics")
+    actions.add_parser("reindex", help="rebuild all indexes")
+    action = actions.add_parser("prune-banned", help="remove viewers at the strike limit")
+    action.add_argument("--channel", help="only this channel")
+    action = actions.add_parser("prune-inactive", help="remove viewers not seen for a number of days")
+    action.add_argument("--days", type=int, required=True, help="days since last seen in chat")
+    action.add_argument("--channel", help="only this channel")
+    action = actions.add_parser("reset-currency", help="set every viewer's currency to 0")
+    action.add_argument("--channel", help="only this channel")
+    action = actions.add_parser("reset-raffle", help="clear raffle entries in a channel")
+    action.add_argument("--channel", required=True, help="channel, such as #example")
+    action = actions.add_parser("reset-viewers", help="delete the Viewers table")
+    action.add_argument("--yes", action="store_true", required=True, help="confirm deleting every viewer")
+    for name, help_text in ( ("export", "write viewers to a file"), ("import", "add or replace viewers from a file") ):
+        action = actions.add_parser(name, help=help_text)
+        action.add_argument("file", help="file name, or - for standard " + ( "output" if name == "export" else "input" ))
+        action.add_argument("--format", choices=("csv", "jsonl"), default="csv", help="file format (default: csv)")
+        if name == "export":
+            action.add_argument("--channel", help="only this channel")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = db_maintenance_arguments()
+    db_connection = db_initialize(arguments.db)
+    db_vt_createtable()
+
+    if arguments.action == "stats":
+        viewers, channels = config.db_action.execute("SELECT COUNT(*), COUNT(DISTINCT Channel) FROM Viewers").fetchone()
+        page_size = config.db_action.execute("PRAGMA page_size").fetchone()[0]
+        page_count = config.db_action.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = config.db_action.execute("PRAGMA freelist_count").fetchone()[0]
+        print(f"Viewers: {viewers} in {channels} channels")
+        print(f"Size: {page_size * page_count} bytes, {page_size * free_pages} free")
+    elif arguments.action == "vacuum":
+        db_vacuum()
+    elif arguments.action == "analyze":
+        db_analyze()
+    elif arguments.action == "reindex":
+        db_reindex()
+    elif arguments.action == "prune-banned":
+        print(f"Removed {db_vt_remove_banned_viewers(arguments.channel)} banned viewers.")
+    elif arguments.action == "prune-inactive":
+        print(f"Removed {db_vt_prune_inactive(arguments.days, arguments.channel)} inactive viewers.")
+    elif arguments.action == "reset-currency":
+        db_vt_resetallcurrency(arguments.channel)
+    elif arguments.action == "reset-raffle":
+        db_vt_reset_all_raffle(arguments.channel)
+    elif arguments.action == "reset-viewers":
+        db_vt_resetviewers()
+    elif arguments.action == "export":
+        row_count = db_vt_export(arguments.file, arguments.format, arguments.channel)
+        print(f"Exported {row_count} viewers.", file=sys.stderr)
+    elif arguments.action == "import":
+        print(f"Imported {db_vt_import(arguments.file, arguments.format)} viewers.", file=sys.stderr)
 
-    print("Closing database connection...")
     db_shutdown(db_connection)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_supervisor.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_supervisor.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_supervisor.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_supervisor.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the bot as several worker processes to use more than one core. Each
+# channel is hashed to one worker, which holds its own connection to Twitch and
+# its own database file. Twitch's rate limits apply to the bot's account, so
+# each worker gets an equal share of them. A worker is only started while it
+# has channels. The supervisor restarts workers that die or stop sending
+# heartbeats, and tells the owning worker to join or part when the channel
+# list changes.
+#
+# Usage: python3 fb_supervisor.py
+
+# Core Modules
+import asyncio                  # Worker side of the control link
+import multiprocessing as mp    # Worker processes
+import os                       # Channel file modification times
+import signal                   # Clean shutdown on SIGTERM
+import zlib                     # Stable channel hashing
+from time import monotonic, sleep
+# Project Modules
+import bot_cfg                  # Bot's config file
+import config                   # Variables shared between modules
+import fb_connection            # Connection to Twitch
+import fb_irc                   # IRC commands
+import fb_log                   # Logging
+import foundationalbot          # The bot run by each worker
+
+logger = fb_log.get_logger("supervisor")
+
+### SUPERVISOR VARIABLES ###
+
+# Seconds between heartbeats sent by a worker
+heartbeat_interval = 5
+# A worker silent this long is considered hung and restarted
+heartbeat_timeout = 30
+# Seconds to wait before restarting a worker that died, doubled per repeated failure
+restart_delay = 1
+restart_delay_max = 60
+
+
+### HELPER FUNCTIONS ###
+
+def channel_shard(channel, worker_count):
+    """ Return the worker number that owns a channel. Stable across runs. """
+    return zlib.crc32(channel.lower().encode("utf-8")) % worker_count
+
+def shard_channels(channels, worker_count):
+    """ Split channels into one set per worker. """
+    shards = [ set() for worker in range(worker_count) ]
+    for channel in channels:
+        shards[channel_shard(channel, worker_count)].add(channel)
+
+    return shards
+
+def shard_db_file(shard):
+    """ Database file used by a worker. """
+    if bot_cfg.db_file == ":memory:":
+        return bot_cfg.db_file
+    db_base, db_extension = os.path.splitext(bot_cfg.db_file)
+    return f"{db_base}.shard{shard}{db_extension}"
+
+def read_channels_file(channels_file):
+    """ Read channels listed one per line, with or without the leading hashtag. """
+    channels = set()
+    with open(channels_file, encoding="utf-8") as channel_list:
+        for line in channel_list:
+            channel = line.strip().lower().lstrip("#")
+            if channel:
+                channels.add(f"#{channel}")
+
+    return channels
+
+
+### WORKER ###
+
+async def _worker_link(control):
+    """ Send heartbeats to the supervisor and carry out its join, part and quit orders. """
+    last_heartbeat = 0.0
+    while True:
+        now = monotonic()
+        if now - last_heartbeat >= heartbeat_interval:
+            control.send(("heartbeat", config.active_connection, len(config.joined_channels)))
+            last_heartbeat = now
+
+        while control.poll():
+            order = control.recv()
+            if order[0] == "join":
+                fb_irc.command_irc_join(order[1])
+            elif order[0] == "part":
+                fb_irc.command_irc_part(order[1])
+            elif order[0] == "quit":
+                fb_connection.irc_shutdown()
+
+        await asyncio.sleep(0.5)
+
+async def _worker_run(control):
+    """ Run the bot alongside the supervisor link. """
+    link = asyncio.ensure_future(_worker_link(control))
+    try:
+        await foundationalbot.bot_main()
+    finally:
+        link.cancel()
+
+def worker_main(shard, channels, control):
+    """ Entry point of a worker process. """
+    # The supervisor handles interrupts and tells workers to quit. Its SIGTERM
+    # handler is inherited on fork; a worker must still die when terminated.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    bot_cfg.channels = sorted(channels)
+    bot_cfg.db_file = shard_db_file(shard)
+    # Twitch counts messages and joins per account, across all the workers' connections
+    workers = bot_cfg.supervisor_workers
+    fb_irc.message_limit_mod = max(fb_irc.message_limit_mod // workers, 1)
+    fb_irc.message_limit_user = max(fb_irc.message_limit_user // workers, 1)
+    fb_irc.join_limit = max(fb_irc.join_limit // workers, 1)
+    # Each worker serves its own stats endpoint
+    if bot_cfg.metrics_port:
+        bot_cfg.metrics_port += shard
+    if bot_cfg.log_file:
+        log_base, log_extension = os.path.splitext(bot_cfg.log_file)
+        bot_cfg.log_file = f"{log_base}.shard{shard}{log_extension}"
+    fb_log.log_setup()
+    logger.info("Worker %d starting with %d channels.", shard, len(channels))
+    try:
+        asyncio.run(_worker_run(control))
+    finally:
+        fb_log.log_shutdown()
+
+
+### SUPERVISOR ###
+
+class Worker:
+    """ Supervisor's view of one worker process. """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.channels = set()
+        self.process = None
+        self.control = None
+        self.last_heartbeat = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+
+    def start(self):
+        """ Start the worker process with its current channels. """
+        self.control, worker_control = mp.Pipe()
+        self.process = mp.Process(
+            target=worker_main, args=(self.shard, self.channels, worker_control),
+            name=f"foundationalbot-{self.shard}", daemon=True
+            )
+        self.process.start()
+        worker_control.close()
+        self.last_heartbeat = monotonic()
+
+    def send(self, *order):
+        """ Send an order to the worker. Ignored if the worker is not running. """
+        try:
+            self.control.send(order)
+        except (OSError, AttributeError):
+            pass
+
+    def kill(self):
+        """ Terminate the worker process, killing it if it does not exit. """
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def check(self, now):
+        """ Read heartbeats and restart the worker when it died or hung. """
+        if self.process is None:
+            # A worker without channels has nothing to connect for
+            if self.channels and now >= self.restart_at:
+                self.start()
+            return
+
+        try:
+            while self.control.poll():
+                self.control.recv()
+                self.last_heartbeat = now
+                self.failures = 0
+        except (EOFError, OSError):
+            pass
+
+        if not self.process.is_alive():
+            logger.error("Worker %d exited with code %s. Restarting.", self.shard, self.process.exitcode)
+            self.process.join()
+        elif now - self.last_heartbeat > heartbeat_timeout:
+            logger.error("Worker %d stopped responding. Restarting.", self.shard)
+            # The old worker must be gone before another connects for its channels
+            self.kill()
+        else:
+            return
+
+        self.control.close()
+        self.process = None
+        self.restart_at = now + min(restart_delay * (2 ** self.failures), restart_delay_max)
+        self.failures += 1
+
+    def stop(self):
+        """ Ask the worker to quit, terminating it if it does not. """
+        if self.process is None:
+            return
+        self.send("quit")
+        self.process.join(10)
+        if self.process.is_alive():
+            self.kill()
+        self.control.close()
+        self.process = None
+
+
+def rebalance(workers, channels):
+    """ Assign channels to workers and tell running workers about the changes. """
+    for worker, shard in zip(workers, shard_channels(channels, len(workers))):
+        # A worker left without channels is stopped, and started again once it has some
+        if not shard:
+            worker.stop()
+            worker.channels = shard
+            continue
+        for channel in sorted(shard - worker.channels):
+            worker.send("join", channel)
+        for channel in sorted(worker.channels - shard):
+            worker.send("part", channel)
+        # A restarted worker starts with the full set
+        worker.channels = shard
+
+def supervisor_main():
+    """ Start the workers and keep them running until interrupted. """
+    channels_file = bot_cfg.supervisor_channels_file
+    channels_mtime = None
+    channels = { channel.lower() for channel in bot_cfg.channels if channel != "#" }
+
+    workers = [ Worker(shard) for shard in range(bot_cfg.supervisor_workers) ]
+    rebalance(workers, channels)
+
+    running = True
+    def stop_running(signal_number, frame):
+        nonlocal running
+        running = False
+    signal.signal(signal.SIGTERM, stop_running)
+
+    try:
+        while running:
+            now = monotonic()
+            for worker in workers:
+                worker.check(now)
+
+            # Pick up added or removed channels
+            if channels_file:
+                try:
+                    mtime = os.stat(channels_file).st_mtime
+                    if mtime != channels_mtime:
+                        channels_mtime = mtime
+                        channels = read_channels_file(channels_file)
+                        logger.info("Channel list loaded: %d channels.", len(channels))
+                        rebalance(workers, channels)
+                except OSError as error:
+                    logger.error("Unable to read channel list: %s", error)
+
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    logger.info("Stopping workers.")
+    for worker in workers:
+        worker.stop()
+
+
+### MAIN ###
+if __name__ == "__main__":
+    fb_log.log_setup()
+    try:
+        supervisor_main()
+    finally:
+        fb_log.log_shutdown()
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_tmi.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_tmi.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_tmi.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_tmi.py. If not, see <http://www.gnu.org/licenses/>.
+
+# A local stand-in for Twitch's chat server, to run the bot without a Twitch
+# account. It logs bots in as Twitch does, answers CAP, PASS, NICK, JOIN, PART
+# and PING, and feeds joined bots generated chat: tagged PRIVMSGs from a crowd
+# of viewers, some of them breaking the chat rules, along with viewer JOINs and
+# PARTs, PINGs, RECONNECT, and MODE and USERSTATE lines giving and taking the
+# bots' moderator status. What the bots send back is
+# recorded, checked against Twitch's rate windows, and timeouts and bans are
+# matched to the rule breaking messages they answer.
+#
+# Usage: python3 fb_tmi.py [--port 6667] [--rate 50] [--users 500] [#channel ...]
+# and set bot_cfg.host_server to 127.0.0.1. fb_loadtest.py runs both at once.
+
+# Core Modules
+import argparse                 # Command line
+import asyncio                  # Server and traffic timing
+import random                   # Generated traffic
+import uuid                     # Message IDs
+import zlib                     # Stable room and user IDs
+from collections import deque   # Rate windows and unanswered violations
+from time import monotonic, time
+# Project Modules
+import fb_irc                   # Twitch's rate windows
+
+### SERVER VARIABLES ###
+
+tmi_host = "tmi.twitch.tv"
+
+# Seconds between rounds of generated traffic
+traffic_tick = 0.01
+# Seconds a connection stays open after being sent RECONNECT
+reconnect_grace = 5
+
+# Chat of the generated viewers. A sequence number is added to each message so
+# the duplicate flood check only sees repeats the test asks for.
+chat_messages = (
+    "hello chat", "LUL", "what game is this?", "gg", "that was close", "PogChamp PogChamp",
+    "first time here, loving the stream", "how long have you been live?", "nice shot",
+    "Kappa", "lol", "this boss is rough", "hi from Germany", "!time", "can you play the new map next?",
+    )
+# Messages the default moderation rules catch: shortened links and all capitals
+violation_messages = (
+    "free followers at bit.ly/f0ll0w", "win a skin here tinyurl.com/sk1nz",
+    "CHECK OUT MY CHANNEL RIGHT NOW EVERYONE", "STOP BEING SO BAD AT THIS GAME",
+    )
+
+
+### HELPER FUNCTIONS ###
+
+def _stable_id(text):
+    return zlib.crc32(text.encode("utf-8")) % 1000000000
+
+def _percentile(values, fraction):
+    """ Value below which the given fraction of values fall. None if there are none. """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _milliseconds(seconds):
+    return "n/a" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+
+### FAKE SERVER ###
+
+class TMIClient:
+    """ One bot connected to the fake server """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.password = None
+        self.logged_in = False
+        self.channels = set()
+        # Times PINGs were sent that are not answered yet
+        self.pings_sent = deque()
+
+    def send(self, line):
+        if not self.writer.is_closing():
+            self.writer.write(f"{line}\r\n".encode("utf-8"))
+
+    async def serve(self):
+        """ Handle lines from the bot until it disconnects """
+        try:
+            while True:
+                raw_line = await self.reader.readline()
+                if not raw_line:
+                    break
+                line = raw_line.decode("utf-8", "replace").rstrip("\r\n")
+                self.server.record(self, line)
+                self.handle(line)
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.server.clients.discard(self)
+            self.writer.close()
+
+    def handle(self, line):
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        if command == "CAP":
+            capabilities = rest.partition(":")[2]
+            self.send(f":{tmi_host} CAP * ACK :{capabilities}")
+        elif command == "PASS":
+            self.password = rest
+        elif command == "NICK":
+            self.login(rest.strip().lower())
+        elif command == "PING":
+            self.send(f":{tmi_host} PONG {tmi_host} :{rest.lstrip(':')}")
+        elif command == "PONG":
+            if self.pings_sent:
+                self.server.pong_times.append(monotonic() - self.pings_sent.popleft())
+        elif not self.logged_in:
+            return
+        elif command == "JOIN":
+            for channel in rest.split(","):
+                self.join(channel.strip().lower())
+        elif command == "PART":
+            for channel in rest.split(","):
+                channel = channel.strip().lower()
+                self.channels.discard(channel)
+                self.send(f":{self.nick}!{self.nick}@{self.nick}.{tmi_host} PART {channel}")
+        elif command == "PRIVMSG":
+            channel, _, message = rest.partition(" :")
+            self.server.bot_message(self, channel.lower(), message)
+        elif command == "QUIT":
+            self.writer.close()
+
+    def login(self, nick):
+        """ Welcome the bot, or turn it away as Twitch does without an OAuth token """
+        self.nick = nick
+        if not ( self.password or "" ).startswith("oauth:"):
+            self.send(f":{tmi_host} NOTICE * :Login authentication failed")
+            self.writer.close()
+            return
+        for numeric, text in (
+                ("001", "Welcome, GLHF!"), ("002", f"Your host is {tmi_host}"), ("003", "This server is rather new"),
+                ("004", "-"), ("375", "-"), ("372", "You are in a maze of twisty passages, all alike."), ("376", ">") ):
+            self.send(f":{tmi_host} {numeric} {nick} :{text}")
+        self.logged_in = True
+        self.server.logins += 1
+
+    def join(self, channel):
+        """ Join a channel, with the replies Twitch sends a bot that is moderator there or not """
+        self.server.rate_check("joins", self.server.join_sends, fb_irc.join_limit, fb_irc.join_period)
+        self.channels.add(channel)
+        self.send(f":{self.nick}!{self.nick}@{self.nick}.{tmi_host} JOIN {channel}")
+        self.send(f":{self.nick}.{tmi_host} 353 {self.nick} = {channel} :{self.nick}")
+        self.send(f":{self.nick}.{tmi_host} 366 {self.nick} {channel} :End of /NAMES list")
+        self.send(self.server.userstate_line(channel, self.nick))
+        self.send(
+            f"@emote-only=0;followers-only=-1;r9k=0;room-id={_stable_id(channel)};slow=0;subs-only=0 "
+            f":{tmi_host} ROOMSTATE {channel}"
+            )
+
+class FakeTMIServer:
+    """ Fake Twitch chat server: logs bots in, relays generated chat and records what they send back. """
+
+    def __init__(self, bot_is_mod=True, record_file=None):
+        # Whether bots are moderators in channels not listed in mod_channels
+        self.bot_is_mod = bot_is_mod
+        # Dictionary of channel:whether the bots are moderators there, once changed by MODE
+        self.mod_channels = {}
+        self.mode_changes = 0
+        self.record_file = record_file
+        self.server = None
+        self.clients = set()
+        # Tasks serving each connection, finished or not
+        self.client_tasks = set()
+        self.started = monotonic()
+        self.logins = 0
+
+        # Lines and chat messages written to bots, and chat messages sent while no bot had joined
+        self.lines_delivered = 0
+        self.messages_delivered = 0
+        self.messages_undelivered = 0
+        # PRIVMSGs received from bots
+        self.messages_received = 0
+
+        # Send times inside each of Twitch's rate windows, the most seen in one window and times a limit was passed
+        self.message_sends = deque()
+        self.user_message_sends = deque()
+        self.join_sends = deque()
+        self.window_peaks = { "messages": 0, "non-moderator messages": 0, "joins": 0 }
+        self.window_violations = dict.fromkeys(self.window_peaks, 0)
+
+        # Dictionary of (channel, username):deque of times rule breaking messages were sent and not yet answered
+        self.violations_pending = {}
+        self.violations_sent = 0
+        # Seconds from a rule breaking message to the bot's timeout or ban
+        self.reaction_times = []
+        # Timeouts and bans of viewers with no rule breaking message waiting
+        self.unprompted_actions = 0
+        # Dictionary of (channel, username):time their timeout ends
+        self.silenced = {}
+        # Seconds from sending a PING to its PONG
+        self.pong_times = []
+
+    async def start(self, host="127.0.0.1", port=6667):
+        """ Start listening. Returns the port, which is chosen by the system if port is 0. """
+        self.server = await asyncio.start_server(self._connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _connection(self, reader, writer):
+        client = TMIClient(self, reader, writer)
+        self.clients.add(client)
+        self.client_tasks.add(asyncio.current_task())
+        try:
+            await client.serve()
+        finally:
+            self.client_tasks.discard(asyncio.current_task())
+
+    async def close(self):
+        """ Stop listening, close every connection and wait for them to finish """
+        if self.server is not None:
+            self.server.close()
+        for client in list(self.clients):
+            client.writer.close()
+        if self.client_tasks:
+            await asyncio.wait(self.client_tasks, timeout=reconnect_grace)
+
+    def record(self, client, line):
+        """ Write a line received from a bot to the record file, with seconds since the start """
+        if self.record_file is not None:
+            self.record_file.write(f"{monotonic() - self.started:.6f}\t{client.nick}\t{line}\n")
+
+    def joined_clients(self, channel):
+        return [ client for client in self.clients if channel in client.channels ]
+
+    def joined(self, channels):
+        """ True once some bot has joined every one of the channels """
+        return all(self.joined_clients(channel) for channel in channels)
+
+    def deliver(self, channel, line):
+        """ Send a line to every bot in a channel. Returns False if none are there. """
+        clients = self.joined_clients(channel)
+        for client in clients:
+            client.send(line)
+        self.lines_delivered += len(clients)
+        return bool(clients)
+
+    async def drain(self):
+        """ Wait while bots fall behind reading """
+        for client in list(self.clients):
+            try:
+                await client.writer.drain()
+            except ConnectionError:
+                pass
+
+    ### BOT OUTPUT ###
+
+    def rate_check(self, window, sends, limit, period):
+        """ Count a send against a rate window, recording the window's peak and whether the limit was passed """
+        now = monotonic()
+        while sends and now - sends[0] >= period:
+            sends.popleft()
+        sends.append(now)
+        self.window_peaks[window] = max(self.window_peaks[window], len(sends))
+        if len(sends) > limit:
+            self.window_violations[window] += 1
+
+    def channel_mod(self, channel):
+        """ Whether the bots are moderators in a channel """
+        return self.mod_channels.get(channel, self.bot_is_mod)
+
+    def userstate_line(self, channel, nick):
+        """ USERSTATE telling a bot its badges and moderator status in a channel """
+        mod = int(self.channel_mod(channel))
+        return (
+            f"@badge-info=;badges={'moderator/1' if mod else ''};color=;display-name={nick};emote-sets=0;"
+            f"mod={mod};subscriber=0;user-type={'mod' if mod else ''} :{tmi_host} USERSTATE {channel}"
+            )
+
+    def bot_message(self, client, channel, message):
+        """ A bot's PRIVMSG: count it against the rate windows and carry out chat commands such as .timeout """
+        self.messages_received += 1
+        # Twitch answers every message with the sender's USERSTATE
+        client.send(self.userstate_line(channel, client.nick))
+        self.rate_check("messages", self.message_sends, fb_irc.message_limit_mod, fb_irc.message_period)
+        if not self.channel_mod(channel):
+            self.rate_check(
+                "non-moderator messages", self.user_message_sends, fb_irc.message_limit_user, fb_irc.message_period
+                )
+
+        words = message.split()
+        if not words or words[0] not in (".timeout", "/timeout", ".ban", "/ban") or len(words) < 2:
+            return
+        user = words[1].lower()
+        if words[0].endswith("ban"):
+            duration = None
+        else:
+            duration = int(words[2]) if len(words) > 2 and words[2].isdigit() else 600
+
+        pending = self.violations_pending.get((channel, user))
+        if pending:
+            self.reaction_times.append(monotonic() - pending.popleft())
+        else:
+            self.unprompted_actions += 1
+        self.silenced[(channel, user)] = float("inf") if duration is None else monotonic() + duration
+        self.deliver(
+            channel,
+            f"@{'' if duration is None else f'ban-duration={duration};'}room-id={_stable_id(channel)};"
+            f"target-user-id={_stable_id(user)};tmi-sent-ts={int(time() * 1000)} :{tmi_host} CLEARCHAT {channel} :{user}"
+            )
+
+    ### GENERATED TRAFFIC ###
+
+    def is_silenced(self, channel, user):
+        """ True while a viewer is timed out or banned """
+        until = self.silenced.get((channel, user))
+        return until is not None and monotonic() < until
+
+    def chat(self, channel, user, message, violation=False, subscriber=False):
+        """ Send a viewer's chat message, tagged as Twitch tags it """
+        user_id = _stable_id(user)
+        line = (
+            f"@badge-info=;badges={'subscriber/1' if subscriber else ''};color=#{user_id % 0xFFFFFF:06X};"
+            f"display-name={user.capitalize()};emotes=;first-msg=0;flags=;id={uuid.uuid4()};mod=0;"
+            f"returning-chatter=0;room-id={_stable_id(channel)};subscriber={int(subscriber)};"
+            f"tmi-sent-ts={int(time() * 1000)};turbo=0;user-id={user_id};user-type= "
+            f":{user}!{user}@{user}.{tmi_host} PRIVMSG {channel} :{message}"
+            )
+        if not self.deliver(channel, line):
+            self.messages_undelivered += 1
+            return
+        self.messages_delivered += 1
+        if violation:
+            self.violations_sent += 1
+            self.violations_pending.setdefault((channel, user), deque()).append(monotonic())
+
+    def viewer_join(self, channel, user):
+        self.deliver(channel, f":{user}!{user}@{user}.{tmi_host} JOIN {channel}")
+
+    def viewer_part(self, channel, user):
+        self.deliver(channel, f":{user}!{user}@{user}.{tmi_host} PART {channel}")
+
+    def bot_mode(self, channel, mode):
+        """ Give (+o) or take (-o) the bots' moderator status in a channel """
+        self.mod_channels[channel] = mode == "+o"
+        self.mode_changes += 1
+        for client in self.joined_clients(channel):
+            client.send(f":jtv MODE {channel} {mode} {client.nick}")
+
+    def userstate(self, channel):
+        """ Send the bots in a channel their USERSTATE """
+        for client in self.joined_clients(channel):
+            client.send(self.userstate_line(channel, client.nick))
+
+    def ping(self):
+        """ PING every bot, timing the PONGs """
+        for client in self.clients:
+            if client.logged_in:
+                client.pings_sent.append(monotonic())
+                client.send(f"PING :{tmi_host}")
+
+    def reconnect(self):
+        """ Ask every bot to reconnect, closing their connections shortly after as Twitch does """
+        loop = asyncio.get_event_loop()
+        for client in list(self.clients):
+            client.send(f":{tmi_host} RECONNECT")
+            loop.call_later(reconnect_grace, client.writer.close)
+
+    def summary(self):
+        """ Report of the traffic and the bots' answers, as lines of text """
+        reactions = self.reaction_times
+        unanswered = sum(len(pending) for pending in self.violations_pending.values())
+        lines = [
+            f"Logins: {self.logins}, moderator status changes: {self.mode_changes}",
+            f"Chat messages delivered: {self.messages_delivered} ({self.messages_undelivered} sent while no bot was joined)",
+            f"Rule breaking messages: {self.violations_sent}, answered: {len(reactions)}, unanswered: {unanswered}, "
+            f"timeouts and bans without one: {self.unprompted_actions}",
+            f"Moderation reaction: p50 {_milliseconds(_percentile(reactions, 0.5))}, "
+            f"p95 {_milliseconds(_percentile(reactions, 0.95))}, max {_milliseconds(max(reactions, default=None))}",
+            f"PING answered: p50 {_milliseconds(_percentile(self.pong_times, 0.5))}, "
+            f"max {_milliseconds(max(self.pong_times, default=None))} ({len(self.pong_times)} PINGs)",
+            f"Messages from bots: {self.messages_received}",
+            ]
+        for window, limit, period in (
+                ("messages", fb_irc.message_limit_mod, fb_irc.message_period),
+                ("non-moderator messages", fb_irc.message_limit_user, fb_irc.message_period),
+                ("joins", fb_irc.join_limit, fb_irc.join_period) ):
+            verdict = "within limit" if not self.window_violations[window] else f"LIMIT PASSED {self.window_violations[window]} times"
+            lines.append(
+                f"Rate window {window}: peak {self.window_peaks[window]} per {period}s of {limit} allowed, {verdict}"
+                )
+
+        return lines
+
+
+### TRAFFIC GENERATOR ###
+
+async def tmi_traffic(server, channels, rate=50, users=500, duration=0, violation_ratio=0.02,
+                      churn_ratio=0.02, subscriber_ratio=0.1, ping_interval=60, reconnect_after=0,
+                      mode_interval=0, userstate_interval=0, seed=None):
+    """ Feed the server's bots generated chat at rate lines per second, for duration seconds or until cancelled.
+
+    Each line is a chat message from a random viewer in a random channel, or
+    their JOIN or PART. A violation_ratio share of the messages break the chat
+    rules. Bots are PINGed every ping_interval seconds and, if reconnect_after
+    is set, asked to reconnect that many seconds in. Every mode_interval
+    seconds the bots' moderator status in a random channel is flipped with a
+    MODE line, and every userstate_interval seconds each channel sends its
+    USERSTATE. Returns the lines generated.
+    """
+    generator = random.Random(seed)
+    viewers = [ f"viewer{number}" for number in range(users) ]
+    present = { channel: set() for channel in channels }
+    start = monotonic()
+    next_ping = start + ping_interval
+    next_mode = start + mode_interval
+    next_userstate = start + userstate_interval
+    reconnect_sent = not reconnect_after
+    generated = 0
+
+    while True:
+        await asyncio.sleep(traffic_tick)
+        now = monotonic()
+        if duration and now - start >= duration:
+            break
+
+        for generated_line in range(int((now - start) * rate) - generated):
+            generated += 1
+            channel = generator.choice(channels)
+            user = generator.choice(viewers)
+            if server.is_silenced(channel, user):
+                continue
+            if user not in present[channel]:
+                present[channel].add(user)
+                server.viewer_join(channel, user)
+            elif generator.random() < churn_ratio:
+                present[channel].discard(user)
+                server.viewer_part(channel, user)
+            elif generator.random() < violation_ratio:
+                server.chat(channel, user, f"{generator.choice(violation_messages)} {generated}", violation=True)
+            else:
+                server.chat(
+                    channel, user, f"{generator.choice(chat_messages)} {generated}",
+                    subscriber=generator.random() < subscriber_ratio
+                    )
+
+        if ping_interval and now >= next_ping:
+            server.ping()
+            next_ping = now + ping_interval
+        if mode_interval and now >= next_mode:
+            channel = generator.choice(channels)
+            server.bot_mode(channel, "-o" if server.channel_mod(channel) else "+o")
+            next_mode = now + mode_interval
+        if userstate_interval and now >= next_userstate:
+            for channel in channels:
+                server.userstate(channel)
+            next_userstate = now + userstate_interval
+        if not reconnect_sent and now - start >= reconnect_after:
+            server.reconnect()
+            reconnect_sent = True
+        await server.drain()
+
+    return generated
+
+
+### MAIN ###
+
+def tmi_arguments(parser):
+    """ Traffic options shared with fb_loadtest.py """
+    parser.add_argument("channels", nargs="*", default=["#loadtest"], help="channels to send chat in (default: #loadtest)")
+    parser.add_argument("--rate", type=float, default=50, help="lines of chat, joins and parts per second (default: 50)")
+    parser.add_argument("--users", type=int, default=500, help="viewers chatting (default: 500)")
+    parser.add_argument("--violations", type=float, default=0.02, help="share of messages breaking the rules (default: 0.02)")
+    parser.add_argument("--ping-interval", type=float, default=60, help="seconds between PINGs (default: 60)")
+    parser.add_argument("--reconnect-after", type=float, default=0, help="send RECONNECT after this many seconds")
+    parser.add_argument("--mode-interval", type=float, default=0, help="seconds between MODE lines flipping the bot's moderator status in a channel")
+    parser.add_argument("--userstate-interval", type=float, default=0, help="seconds between USERSTATE lines in each channel")
+    parser.add_argument("--not-mod", action="store_true", help="the bot is not a moderator in the channels")
+    parser.add_argument("--record", help="file to record what the bot sends, with timestamps")
+    parser.add_argument("--seed", type=int, help="seed for repeatable traffic")
+
+async def _tmi_main(arguments):
+    record_file = open(arguments.record, "w", encoding="utf-8") if arguments.record else None
+    server = FakeTMIServer(not arguments.not_mod, record_file)
+    port = await server.start(arguments.host, arguments.port)
+    print(f"Listening on {arguments.host}:{port}. Press Ctrl-C to stop.")
+    try:
+        while not server.joined(arguments.channels):
+            await asyncio.sleep(0.1)
+        await tmi_traffic(
+            server, arguments.channels, arguments.rate, arguments.users, arguments.duration, arguments.violations,
+            ping_interval=arguments.ping_interval, reconnect_after=arguments.reconnect_after,
+            mode_interval=arguments.mode_interval, userstate_interval=arguments.userstate_interval, seed=arguments.seed
+            )
+    finally:
+        await server.close()
+        if record_file is not None:
+            record_file.close()
+        print("\n".join(server.summary()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for Twitch's chat server.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=6667, help="port to listen on (default: 6667)")
+    parser.add_argument("--duration", type=float, default=0, help="seconds of traffic once the bot joins; 0 until stopped")
+    tmi_arguments(parser)
+    try:
+        asyncio.run(_tmi_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -14,25 +14,227 @@
 # You should have received a copy of the GNU General Public Liencese
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+# Sound effects play one at a time through a single long-running VLC, which is
+# started with the bot and controlled over a local socket with VLC's remote
+# control (RC) commands. Any program that accepts the same commands on that
+# port can stand in for VLC through bot_cfg.sfx_player_command.
+
 # Core modules
-import subprocess as sp # Calling system programs
+import asyncio          # Player control task
 import os               # Collaborating with the Operating System
+import subprocess as sp # Calling system programs
+from collections import deque   # Playback queue
+from time import monotonic      # Effect cooldowns
 # Project modules
 import bot_cfg          # Bot's config file
+import fb_log           # Logging
+import fb_pool          # Background work pools
+
+logger = fb_log.get_logger("vlc")
+
+### PLAYER VARIABLES ###
+
+# Files waiting to play
+vlc_queue = deque()
+# Set when an effect is queued, skipped or stopped; None while the player task is not running
+vlc_wakeup = None
+# Set to cut the current effect short
+vlc_skip_requested = False
+# Dictionary of file:time last queued, for the per-effect cooldown
+vlc_last_queued = {}
+
+# Seconds between checks on whether the current effect finished
+vlc_poll_interval = 0.25
+# Seconds to wait for the player to start listening, start playing or answer a command
+vlc_response_timeout = 5
+
 
+### PLAYBACK QUEUE ###
 
-def vlc_play_audio(file):
-    """ Play the given file or URL """
+def vlc_enqueue(file):
+    """ Queue a file or URL to play. Returns True if queued. """
+    if not file:
+        return False
+    if vlc_wakeup is None:
+        logger.error("Sound effect player is not running.")
+        return False
 
+    now = monotonic()
+    if now - vlc_last_queued.get(file, -bot_cfg.sfx_cooldown) < bot_cfg.sfx_cooldown:
+        return False
+    if len(vlc_queue) >= bot_cfg.sfx_queue_size:
+        logger.info("Sound effect queue full; %s not queued.", file)
+        return False
+
+    vlc_last_queued[file] = now
+    vlc_queue.append(file)
+    vlc_wakeup.set()
+    return True
+
+def vlc_skip():
+    """ Stop the current effect and move on to the next one """
+    global vlc_skip_requested
+    vlc_skip_requested = True
+    if vlc_wakeup is not None:
+        vlc_wakeup.set()
+
+def vlc_stop():
+    """ Stop the current effect and drop the queued ones """
+    vlc_queue.clear()
+    vlc_skip()
+
+
+### PLAYER ###
+
+def _player_command():
+    """ Command line starting the player, or None if no player is available. """
+    if bot_cfg.sfx_player_command:
+        return list(bot_cfg.sfx_player_command)
     # Only attempt to invoke VLC if bot_cfg.vlc_bin is valid path
-    if os.path.isfile(bot_cfg.vlc_bin) and os.access (bot_cfg.vlc_bin, os.X_OK):
-        # Invoke VLC without: error messages, interface, video playback
-        # Close VLC when finished
-        VLC_command=[
-            bot_cfg.vlc_bin, "--quiet", "-I null", "--no-video",
-            "--play-and-exit", file
-            ]
-        playback = sp.Popen(VLC_command)
-        print(f"LOG: Playback started of {file}")
-    else:
-        print(f"ERR: VLC not found at {bot_cfg.vlc_bin} or incorrect permissions.")
+    if not ( os.path.isfile(bot_cfg.vlc_bin) and os.access(bot_cfg.vlc_bin, os.X_OK) ):
+        return None
+    # Invoke VLC without: error messages, video playback; listen for RC commands on localhost
+    vlc_command = [
+        bot_cfg.vlc_bin, "--quiet", "--no-video",
+        "-I", "rc", "--rc-host", f"127.0.0.1:{bot_cfg.sfx_player_port}"
+        ]
+    # Keep VLC from opening a console window
+    if os.name == "nt":
+        vlc_command.append("--rc-quiet")
+    return vlc_command
+
+def _player_spawn():
+    """ Start the player process. Returns it, or None if no player is available. Run in a pool thread. """
+    player_command = _player_command()
+    if player_command is None:
+        return None
+    return sp.Popen(player_command, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+class VLCPlayer:
+    """ The player process and the RC connection to it. """
+
+    def __init__(self):
+        self.process = None
+        self.reader = None
+        self.writer = None
+
+    def running(self):
+        return self.writer is not None and self.process is not None and self.process.poll() is None
+
+    async def start(self):
+        """ Start the player and connect to it. Returns True on success. """
+        # Checking for the executable and starting a process can block; neither holds up chat
+        try:
+            self.process = await fb_pool.pool_run(fb_pool.POOL_IO, _player_spawn)
+        except OSError as error:
+            logger.error("Sound effect player failed to start: %s", error)
+            return False
+        if self.process is None:
+            logger.error("VLC not found at %s or incorrect permissions.", bot_cfg.vlc_bin)
+            return False
+
+        deadline = monotonic() + vlc_response_timeout
+        # The player needs a moment before it listens
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection("127.0.0.1", bot_cfg.sfx_player_port)
+                logger.info("Sound effect player started.")
+                return True
+            except OSError:
+                if self.process.poll() is not None or monotonic() > deadline:
+                    logger.error("Sound effect player failed to start.")
+                    await self.close()
+                    return False
+                await asyncio.sleep(0.1)
+
+    async def send(self, line):
+        self.writer.write(f"{line}\n".encode("utf-8"))
+        await self.writer.drain()
+
+    async def is_playing(self):
+        """ Ask the player whether it is playing """
+        await self.send("is_playing")
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), vlc_response_timeout)
+            if not line:
+                raise ConnectionError("Sound effect player closed the connection")
+            # Replies may follow the RC prompt; other output such as status changes is skipped
+            reply = line.decode("utf-8", "replace").strip().lstrip("> ")
+            if reply in ("0", "1"):
+                return reply == "1"
+
+    async def play(self, file):
+        """ Play a file until it ends or is skipped """
+        global vlc_skip_requested
+        await self.send("clear")
+        await self.send(f"add {file}")
+        logger.info("Playback started of %s", file)
+
+        started = False
+        deadline = monotonic() + vlc_response_timeout
+        while not vlc_skip_requested:
+            if await self.is_playing():
+                started = True
+            elif started or monotonic() > deadline:
+                return
+            vlc_wakeup.clear()
+            try:
+                await asyncio.wait_for(vlc_wakeup.wait(), vlc_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+        vlc_skip_requested = False
+        await self.send("stop")
+
+    async def close(self):
+        """ Shut the player down and reap its process """
+        if self.writer is not None:
+            try:
+                await self.send("shutdown")
+            except ConnectionError:
+                pass
+            self.writer.close()
+            self.reader = self.writer = None
+
+        if self.process is not None:
+            deadline = monotonic() + vlc_response_timeout
+            while self.process.poll() is None and monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            if self.process.poll() is None:
+                self.process.kill()
+                await fb_pool.pool_run(fb_pool.POOL_IO, self.process.wait)
+            self.process = None
+
+async def vlc_player():
+    """ Play queued effects one after another until cancelled """
+    global vlc_wakeup, vlc_skip_requested
+    vlc_wakeup = asyncio.Event()
+    player = VLCPlayer()
+    try:
+        # Start ahead of the first effect so it plays without delay
+        if bot_cfg.sfx1_path or bot_cfg.sfx2_path:
+            await player.start()
+
+        while True:
+            if not vlc_queue:
+                vlc_wakeup.clear()
+                await vlc_wakeup.wait()
+                continue
+
+            file = vlc_queue.popleft()
+            vlc_skip_requested = False
+            if not player.running():
+                # Reap a player that exited before starting another
+                await player.close()
+                if not await player.start():
+                    vlc_queue.clear()
+                    continue
+            try:
+                await player.play(file)
+            except (ConnectionError, asyncio.TimeoutError):
+                logger.error("Sound effect player stopped responding; restarting it.")
+                await player.close()
+    finally:
+        vlc_wakeup = None
+        vlc_queue.clear()
+        await player.close()
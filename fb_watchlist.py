@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright 2018 Ian Leonard <antonlacon@gmail.com>
+#
+# This file is fb_watchlist.py and is part of the Foundational IRC Bot for
+# Twitch.tv project.
+#
+# fb_watchlist.py is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# fb_watchlist.py is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with fb_watchlist.py. If not, see <http://www.gnu.org/licenses/>.
+
+# Core Modules
+import re                   # Regex engine the compiled watchlist runs on
+# Project Modules
+import language_watchlist   # Collection of words to take action on
+
+# The watchlist entries are literal strings. They are folded into a trie and
+# rendered as one regex, so a message is scanned once no matter how many
+# entries the list holds; each position only follows the branch for the
+# character found there. The regex finds the longest entry at each position;
+# entries that are prefixes of it ("bit" of "bitly.com") are looked up from a
+# table built with the trie.
+
+### HELPER FUNCTIONS ###
+
+def _watchlist_trie(word_list):
+    """ Build a character trie from the word list. The "" key marks the end of a word. """
+    trie = {}
+    for word in word_list:
+        if not word:
+            continue
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[""] = True
+
+    return trie
+
+def _watchlist_prefixes(node, word="", ending=()):
+    """ Map each word in the trie to the words ending at or before its end, shortest first. """
+    prefixes = {}
+    if "" in node:
+        ending = ( *ending, word )
+        prefixes[word] = ending
+    for character, child in node.items():
+        if character != "":
+            prefixes.update(_watchlist_prefixes(child, word + character, ending))
+
+    return prefixes
+
+def _watchlist_pattern(node):
+    """ Render a trie node as a regex fragment. Returns None for a leaf. """
+    word_ends_here = "" in node
+    if word_ends_here and len(node) == 1:
+        return None
+
+    branches = []
+    leaf_characters = []
+    for character in sorted(key for key in node if key != ""):
+        branch = _watchlist_pattern(node[character])
+        if branch is None:
+            leaf_characters.append(re.escape(character))
+        else:
+            branches.append(re.escape(character) + branch)
+
+    # Characters that end a word with nothing after them collapse into one class
+    if len(leaf_characters) == 1:
+        branches.append(leaf_characters[0])
+    elif leaf_characters:
+        branches.append(f"[{''.join(leaf_characters)}]")
+
+    if len(branches) == 1 and not word_ends_here:
+        return branches[0]
+    pattern = f"(?:{'|'.join(branches)})"
+    # A shorter word ends here; the longer branches are tried first
+    if word_ends_here:
+        pattern += "?"
+
+    return pattern
+
+
+### WATCHLIST ENGINE ###
+
+class WatchlistMatcher:
+    """ A compiled watchlist: the trie regex and, for each entry, the entries it starts with. """
+    __slots__ = ("pattern", "prefixes")
+
+    def __init__(self, pattern, prefixes):
+        self.pattern = pattern
+        self.prefixes = prefixes
+
+def watchlist_compile(word_list):
+    """ Compile a list of literal strings into one matcher. Returns None for an empty list. """
+    trie = _watchlist_trie(word_list)
+    if not trie:
+        return None
+    # Zero-width lookahead so overlapping entries (adcraft.co and t.co) are all reported
+    return WatchlistMatcher(re.compile(f"(?=({_watchlist_pattern(trie)}))"), _watchlist_prefixes(trie))
+
+def watchlist_matches(message, matcher=None):
+    """ Return each distinct watchlist entry found in message, in order of appearance. """
+    if matcher is None:
+        matcher = prohibited_words_matcher
+    if matcher is None:
+        return []
+
+    return list(dict.fromkeys(
+        word for match in matcher.pattern.finditer(message) for word in matcher.prefixes[match.group(1)]
+        ))
+
+def watchlist_first(message, matcher=None):
+    """ Return the first watchlist entry found in message, or None. """
+    if matcher is None:
+        matcher = prohibited_words_matcher
+    if matcher is None:
+        return None
+
+    match = matcher.pattern.search(message)
+    return matcher.prefixes[match.group(1)][0] if match is not None else None
+
+
+### PARSING VARIABLES ###
+
+# Combined watchlist compiled once at import
+prohibited_words_matcher = watchlist_compile(language_watchlist.prohibited_words)
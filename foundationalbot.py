@@ -21,293 +21,294 @@
 # along with foundationalbot.py. If not, see <http://www.gnu.org/licenses/>.
 
 # Core Modules
-import socket                   # IRC networking
-import re                       # Regex parsing to parse chat messages
-from time import sleep          # sleep() command
+import asyncio                  # Asynchronous networking
+import logging                  # Log levels
+import sqlite3                  # Database errors
 from sys import exit            # exit() command
-from datetime import datetime   # date functions
 # Project Modules
 import bot_cfg                  # Bot's config file
 import config                   # Variables shared between modules
+import fb_blocklist             # Blocked web address domains
 import fb_commands              # Command parser
+import fb_connection            # Connection to Twitch
+import fb_currency              # Viewer presence and currency
 import fb_irc                   # IRC commands
+import fb_log                   # Logging
+import fb_metrics               # Counters and stage timings
+import fb_moderation            # Chat moderation rules
+import fb_parser                # IRC line parser
+import fb_pool                  # Background work pools
+import fb_raffle                # Raffle entrants
+import fb_reload                # Reloading settings while running
 import fb_sql                   # SQLite database interaction
-import language_watchlist       # Collection of words to take action on
+import fb_vlc                   # Sound effect player
 
+# Subsystem loggers
+logger = fb_log.get_logger("irc")
+chat_logger = fb_log.get_logger("chat")
+moderation_logger = fb_log.get_logger("moderation")
+sql_logger = fb_log.get_logger("sql")
 
-### PARSING VARIABLES ###
-
-# Regular expressions that will be used frequently so build the regex once to quickly retrieve, use grouping to reuse
-irc_message_regex = re.compile(
-    r"^@.*;display-name=(.*?);.*;mod=\d;.*;subscriber=(\d);.*;user-type=(\w*) :(\w+)!\w+@\w+\.tmi\.twitch\.tv PRIVMSG (#\w+) :"
-    )
-irc_join_regex = re.compile(r"^:\w+!(\w+)@\w+\.tmi\.twitch\.tv JOIN #\w+")
-irc_userstate_regex = re.compile(r"^@.*;mod=(\d);.* :tmi\.twitch\.tv USERSTATE (#\w+)")
-
-# IRC response buffer (incoming messages)
-irc_response_buffer = ""
 
 ### SUPPORT FUNCTIONS ###
 
-def add_user_strike(user):
+def add_user_strike(irc_channel, user):
     """ Strikeout system implementation. Adds a strike and checks effects. """
-    user_displayname = fb_sql.db_vt_show_displayname(user)
-    user_strike_count = fb_sql.db_vt_show_strikes(user)
+    user_displayname = fb_sql.db_vt_show_displayname(irc_channel, user)
     # hand out the strike and check effects
     if bot_cfg.strikes_until_ban != 0:
-        user_strike_count += 1
+        user_strike_count = fb_sql.db_vt_increment_strikes(irc_channel, user)
+    else:
+        user_strike_count = fb_sql.db_vt_show_strikes(irc_channel, user)
+    fb_metrics.metrics_count("strikes")
 
     # If user reaches the strike limit, hand out a ban
     if user_strike_count == bot_cfg.strikes_until_ban and bot_cfg.strikes_until_ban != 0:
-        fb_irc.command_irc_ban(user)
-        print(f"LOG: Banned user per strikeout system: {user}")
-        fb_irc.command_irc_send_message(f"{user_displayname} banned per strikeout system.")
+        fb_irc.command_irc_ban(irc_channel, user)
+        fb_metrics.metrics_count("bans")
+        moderation_logger.info("%s: Banned user per strikeout system: %s", irc_channel, user)
+        fb_irc.command_irc_send_message(irc_channel, f"{user_displayname} banned per strikeout system.")
     else:
-        # Write updated strike count to database
-        fb_sql.db_vt_change_strikes(user, user_strike_count)
-        print(f"LOG: Additional strike added to: {user}. User's strike count is: {str(user_strike_count)}")
+        moderation_logger.info("%s: Additional strike added to: %s. User's strike count is: %s", irc_channel, user, user_strike_count)
 
         # If user exceeded half of the allowed strikes, give a longer timeout and message in chat
         if user_strike_count >= (bot_cfg.strikes_until_ban/2) and bot_cfg.strikes_until_ban != 0:
-            fb_irc.command_irc_timeout(user, bot_cfg.strikes_timeout_duration)
+            fb_irc.command_irc_timeout(irc_channel, user, bot_cfg.strikes_timeout_duration)
+            fb_metrics.metrics_count("timeouts")
             fb_irc.command_irc_send_message(
+                irc_channel,
                 f"Warning: {user_displayname} in timeout for chat rule violation. {str(bot_cfg.strikes_timeout_duration/60)} minutes."
                 )
-            print(f"LOG: User {user} silenced per strikeout policy.")
+            moderation_logger.info("%s: User %s silenced per strikeout policy.", irc_channel, user)
         # If user does not have many strikes, clear message(s) and warn
         else:
-            fb_irc.command_irc_timeout(user, 1)
-            fb_irc.command_irc_send_message(f"Warning: {user_displayname} messages purged for chat rule violation.")
-            print(f"LOG: Messages from {user} purged.")
-
-
-### NEGOTIATING CONNECTION TO TWITCH ###
-def initialize_irc_connection():
-    """ Initialize the IRC connection to Twitch """
-    irc_response_buffer = ""
-    initial_connection = False
-    config.messages_sent = 0
-
-    # Connect to Twitch and enter bot's channel
-    config.irc_socket = socket.socket()
-    config.irc_socket.connect((bot_cfg.host_server, bot_cfg.host_port))
-    config.irc_socket.send(f"PASS {bot_cfg.bot_password}\r\n".encode("utf-8"))
-    config.irc_socket.send(f"NICK {bot_cfg.bot_handle}\r\n".encode("utf-8"))
-    initial_connection = True
-
-    # Join broadcaster's channel
-    fb_irc.command_irc_join(bot_cfg.channel)
-
-    # Initial login messages
-    # XXX: unbound while loop; count messages and abort if it's reaches a threshold?
-    while initial_connection:
-        irc_response_buffer = irc_response_buffer + config.irc_socket.recv(1024).decode("utf-8")
-        irc_response = re.split(r"[~\r\n]+", irc_response_buffer)
-        irc_response_buffer = irc_response.pop()
-
-        for message_line in irc_response:
-            print(message_line)
-            # Connected to Twitch IRC server but failed to login
-            if ":tmi.twitch.tv NOTICE * :Login unsuccessful" in message_line:
-                config.active_connection = False
-                initial_connection = False
-            # Last line of a successful login
-            elif f":tmi.twitch.tv 376 {bot_cfg.bot_handle} :>" in message_line:
-                # Request full messaging metadata from IRC messages
-                config.irc_socket.send(
-                    "CAP REQ :twitch.tv/tags twitch.tv/commands twitch.tv/membership\r\n".encode("utf-8")
-                    )
-                config.active_connection = True
-                initial_connection = False
-    # pause for rate limiter and the number of messages sent in login process
-    sleep((1 / config.message_rate) * (config.messages_sent + 3))
-
-
-### PARSER LOOP ###
-def main_parser_loop():
-    """ The main parser loop that processes messages from the IRC server """
-    irc_response_buffer = ""
-    bot_is_mod = False
-
-    # Parser loop
-    while config.active_connection:
-
-        # Messages being received from the IRC server stored in a buffer in case of incomplete messages
-        try:
-            irc_response_buffer = irc_response_buffer + config.irc_socket.recv(1024).decode("utf-8")
-        except UnicodeDecodeError:
-            print("ERR: Unicode decoding error. Message ignored.")
-            continue
-        irc_response = re.split(r"[~\r\n]+", irc_response_buffer)
-        irc_response_buffer = irc_response.pop()
-
-        # Count messages sent as a rate limiter to avoid global timeout
-        config.messages_sent = 0
-
-        # Timestamp
-        now_local_logging = datetime.now().strftime("%Y%m%d %H:%M:%S")
-
-        for message_line in irc_response:
-
-            # Twitch will check that clients are still alive; respond with PONG
-            if message_line == "PING :tmi.twitch.tv":
-                fb_irc.command_irc_ping_respond()
-                print("LOG: Received PING. Sent PONG.")
-
-            # Majority of parsing will be done on PRIVMSGs from the server
-            elif re.search(r" PRIVMSG ", message_line):
-# Debug option
-#               print(message_line)
-
-                # Channel message parsing; adjust groups for more variables
-                try:
-                    parsed_irc_message = irc_message_regex.search(message_line)
-                    user_display_name = parsed_irc_message.group(1)
-                    user_subscriber_status = parsed_irc_message.group(2)
-                    user_mod_status = parsed_irc_message.group(3) # is this correct?
-                    username = parsed_irc_message.group(4)
-                    irc_channel = parsed_irc_message.group(5)
-                    irc_channel_broadcaster = irc_channel[1:]
-                    message = irc_message_regex.sub("", message_line)
-                except:
-                    print(f"ERR: {now_local_logging}: Unparsable chat message")
-                    print(message_line)
-                    continue
-
-                print(f"{now_local_logging}: {irc_channel}: {username}: {message}")
-
-                # Add username to database in case message sent before JOIN message
-                if fb_sql.db_vt_test_username(username) == False:
-                    fb_sql.db_vt_addentry(username, user_display_name)
-                # Viewer may have been added to DB by JOIN message, or changed their displayname; update it
-                elif user_display_name != fb_sql.db_vt_show_displayname(username):
-                    fb_sql.db_vt_change_displayname(username, user_display_name)
-
-                # Command Parser
-                if message.startswith("!"):
-                    fb_commands.command_parser(username, user_mod_status, irc_channel, message)
-
-                # Raffle monitor
-                if ( config.raffle_active == True and
-                     message.strip() == config.raffle_keyword and
-                     not fb_sql.db_vt_show_raffle(username) ):
-
-                    # Add user to raffle
-                    fb_sql.db_vt_change_raffle(username)
-                    print(f"LOG: {username} added to {irc_channel} raffle.")
-
-                # Message censor. Employ a strikeout system and ban policy.
-                if ( bot_is_mod == True and
-                     username != irc_channel_broadcaster and
-                     user_mod_status == "" ):
-                    for language_control_test in language_watchlist.prohibited_words:
-                        if re.search(language_control_test, message):
-
-                            add_user_strike(username)
-                            print(f"LOG: {username} earned a strike for violating the language watchlist.")
-
-                    # Messages longer than set length in all uppercase count as a strike
-                    if ( len(message) >= bot_cfg.uppercase_message_suppress_length and
-                         message == message.upper() ):
-                        add_user_strike(username)
-                        print(f"LOG: {username} earned a timeout for a message in all capitals. Strike added.")
-
-            # Monitor MODE messages to detect if bot gains or loses moderator status
-            elif re.search(r" MODE ", message_line):
-                if f"#{bot_cfg.channel} +o {bot_cfg.bot_handle}" in message_line:
-                    print("LOG: Bot gained mod status. Adjusting message rate and monitoring chat.")
-                    bot_is_mod = True
-                    config.message_rate = (100/30)
-                elif f"#{bot_cfg.channel} -o {bot_cfg.bot_handle}" in message_line:
-                    print("LOG: Bot lost mod status. Adjusting message rate and no longer moderating chat.")
-                    bot_is_mod = False
-                    config.message_rate = (20/30)
-
-            # Handle requests to reconnect to the chat servers from Twitch
-            elif re.search(r" RECONNECT ", message_line):
-                print("LOG: Reconnecting to server based on message from server.")
-                fb_irc.command_irc_part(bot_cfg.channel, True)
-                fb_irc.command_irc_send_message("Ordered by Twitch to reconnect; back in a jiffy!")
-                config.irc_socket.close()
-                config.active_connection = False
-
-            # Add viewers to database on join
-            elif re.search(r" JOIN ", message_line):
-                # Parse JOIN message to obtain username
-                parsed_irc_message = irc_join_regex.search(message_line)
-                username = parsed_irc_message.group(1)
-
-                # Add username to database if not present
-                if fb_sql.db_vt_test_username(username) == False:
-                    fb_sql.db_vt_addentry(username)
-
-            # Check USERSTATE for moderator status
-            elif re.search(r" USERSTATE ", message_line):
-                parsed_irc_message = irc_userstate_regex.search(message_line)
-                user_mod_status = parsed_irc_message.group(1)
-                irc_channel = parsed_irc_message.group(2)
-
-                if user_mod_status == "1" and bot_is_mod == False:
-                    print("LOG: Bot gained mod status. Adjusting message rate and monitoring chat.")
-                    bot_is_mod = True
-                    config.message_rate = (100/30)
-                elif user_mod_status == "0" and bot_is_mod == True:
-                    print("LOG: Bot lost mod status. Adjusting message rate and no longer moderating chat.")
-                    bot_is_mod = False
-                    config.message_rate = (20/30)
-
-            # Ignore the following:
-            # CLEARCHAT: Viewer's chat messages being purged
-            # GLOBALUSERSTATE: ?
-            # HOSTTARGET: Host mode being turned on/off
-            # NOTICE: ?
-            # PART: People leaving the chat room
-            # ROOMSTATE: Room status (slow-mode, sub-only, etc)
-            elif re.search(r" CLEARCHAT ", message_line) or \
-            re.search(r" GLOBALUSERSTATE ", message_line) or \
-            re.search(r" HOSTTARGET ", message_line) or \
-            re.search(r" NOTICE ", message_line) or \
-            re.search(r" PART ", message_line) or \
-            re.search(r" ROOMSTATE ", message_line):
-                break
-
-            # Not an IRC message covered elsewhere
-            else:
-                print(message_line)
-
-# Database debugging
-#           print(fb_sql.db_vt_show_all())
-
-            # Rate control on sending messages
-#           print(f"Messages sent: {str(config.messages_sent)}")
-            sleep((1 / config.message_rate) * config.messages_sent)
+            fb_irc.command_irc_timeout(irc_channel, user, 1)
+            fb_irc.command_irc_send_message(irc_channel, f"Warning: {user_displayname} messages purged for chat rule violation.")
+            moderation_logger.info("%s: Messages from %s purged.", irc_channel, user)
+
+def moderate_message(irc_channel, username, message):
+    """ Hand out a strike for a message breaking the chat rules """
+    verdict = fb_moderation.moderation_check(irc_channel, username, message)
+    if verdict is not None:
+        rule_name, reason = verdict
+        add_user_strike(irc_channel, username)
+        moderation_logger.info("%s: %s earned a strike for %s (rule: %s).", irc_channel, username, reason, rule_name)
 
-### MAIN ###
-if __name__ == "__main__":
 
+### IRC MESSAGE HANDLERS ###
+
+def bot_mod_status_change(irc_channel, bot_is_mod):
+    """ Adjust message rate and chat monitoring when the bot's moderator status in a channel changes. """
+    if bot_is_mod:
+        logger.info("Bot gained mod status in %s. Adjusting message rate and monitoring chat.", irc_channel)
+    else:
+        logger.info("Bot lost mod status in %s. Adjusting message rate and no longer moderating chat.", irc_channel)
+    fb_irc.irc_set_mod_status(irc_channel, bot_is_mod)
+
+def handle_privmsg(irc_message):
+    """ Majority of parsing will be done on PRIVMSGs from the server """
+    logger.debug("%s", irc_message.raw)
+
+    # Channel message parsing
+    username = irc_message.nick
+    irc_channel = irc_message.channel
+    message = irc_message.trailing
+    if username is None or irc_channel is None or message is None:
+        logger.error("Unparsable chat message: %s", irc_message.raw)
+        return
+    # Route messages only for channels the bot is in
+    if irc_channel not in config.joined_channels:
+        return
+    user_display_name = irc_message.tags.get("display-name", "")
+    user_subscriber_status = irc_message.tags.get("subscriber", "0")
+    user_mod_status = irc_message.tags.get("user-type", "")
+    irc_channel_broadcaster = irc_channel[1:]
+
+    chat_logger.info("%s: %s: %s", irc_channel, username, message)
+
+    # Add username to database in case message sent before JOIN message. Viewer may
+    # have been added to DB by JOIN message, or changed their displayname; update it
+    with fb_metrics.stage_timer("database"):
+        fb_sql.db_vt_upsert_viewer(irc_channel, username, user_display_name)
+    fb_currency.presence_join(irc_channel, username)
+
+    # Command Parser
+    if message.startswith("!"):
+        with fb_metrics.stage_timer("commands"):
+            fb_commands.command_parser(username, irc_channel, message, irc_message.tags)
+
+    # Raffle monitor
+    if fb_raffle.raffle_check_message(irc_channel, username, message):
+        # User added to raffle
+        logger.info("%s added to %s raffle.", username, irc_channel)
+
+    # Message censor. Employ a strikeout system and ban policy.
+    if ( config.bot_is_mod.get(irc_channel, False) == True and
+         username != irc_channel_broadcaster and
+         user_mod_status == "" ):
+        with fb_metrics.stage_timer("moderation"):
+            moderate_message(irc_channel, username, message)
+
+def handle_mode(irc_message):
+    """ Monitor MODE messages to detect if bot gains or loses moderator status """
+    irc_channel = irc_message.channel
+    if irc_channel not in config.joined_channels or irc_message.params[2:] != [bot_cfg.bot_handle]:
+        return
+    if irc_message.params[1] == "+o":
+        bot_mod_status_change(irc_channel, True)
+    elif irc_message.params[1] == "-o":
+        bot_mod_status_change(irc_channel, False)
+
+def handle_reconnect(irc_message):
+    """ Handle requests to reconnect to the chat servers from Twitch """
+    logger.info("Reconnecting to server based on message from server.")
+    # Channels are rejoined on the new connection
+    fb_connection.irc_reconnect()
+
+def handle_join(irc_message):
+    """ Add viewers to database on join """
+    username = irc_message.nick
+    irc_channel = irc_message.channel
+
+    # Twitch sends JOINs for everyone in chat again after the bot joins
+    if username == bot_cfg.bot_handle:
+        fb_currency.presence_clear(irc_channel)
+    # Add username to database if not present
+    elif username is not None and irc_channel in config.joined_channels:
+        fb_sql.db_vt_upsert_viewer(irc_channel, username)
+        fb_currency.presence_join(irc_channel, username)
+
+def handle_part(irc_message):
+    """ Viewers leaving the chat room no longer earn currency """
+    username = irc_message.nick
+    irc_channel = irc_message.channel
+
+    if username == bot_cfg.bot_handle:
+        fb_currency.presence_clear(irc_channel)
+    elif username is not None:
+        fb_currency.presence_part(irc_channel, username)
+
+def handle_userstate(irc_message):
+    """ Check USERSTATE for moderator status """
+    user_mod_status = irc_message.tags.get("mod")
+    irc_channel = irc_message.channel
+    if irc_channel not in config.joined_channels:
+        return
+    bot_is_mod = config.bot_is_mod.get(irc_channel, False)
+
+    if user_mod_status == "1" and bot_is_mod == False:
+        bot_mod_status_change(irc_channel, True)
+    elif user_mod_status == "0" and bot_is_mod == True:
+        bot_mod_status_change(irc_channel, False)
+
+def handle_ignore(irc_message):
+    """ IRC messages the bot has no use for """
+    pass
+
+# Route each IRC command to its handler. Ignored:
+# CLEARCHAT: Viewer's chat messages being purged
+# GLOBALUSERSTATE: ?
+# HOSTTARGET: Host mode being turned on/off
+# NOTICE: ?
+# PONG: Answer to the keepalive PING
+# ROOMSTATE: Room status (slow-mode, sub-only, etc)
+irc_command_handlers = {
+    "PRIVMSG": handle_privmsg,
+    "MODE": handle_mode,
+    "RECONNECT": handle_reconnect,
+    "JOIN": handle_join,
+    "USERSTATE": handle_userstate,
+    "CLEARCHAT": handle_ignore,
+    "GLOBALUSERSTATE": handle_ignore,
+    "HOSTTARGET": handle_ignore,
+    "NOTICE": handle_ignore,
+    "PONG": handle_ignore,
+    "PART": handle_part,
+    "ROOMSTATE": handle_ignore,
+    }
+
+
+### PARSER ###
+def process_irc_line(message_line):
+    """ Parse a line from the IRC server and dispatch it to its handler """
+    with fb_metrics.stage_timer("line"):
+        with fb_metrics.stage_timer("parse"):
+            irc_message = fb_parser.parse_irc_line(message_line)
+
+        if irc_message is not None and irc_message.command in irc_command_handlers:
+            fb_metrics.metrics_count("lines_by_command", irc_message.command)
+            irc_command_handlers[irc_message.command](irc_message)
+        # Not an IRC message covered elsewhere
+        else:
+            fb_metrics.metrics_count("lines_by_command", "other")
+            logger.debug("%s", message_line)
+
+async def database_committer():
+    """ Commit the database in batches rather than per message, from a pool thread """
+    while True:
+        await asyncio.sleep(1)
+        fb_raffle.raffle_persist()
+        batch = fb_sql.db_commit_tick()
+        if batch is None:
+            continue
+        committed = False
+        try:
+            await fb_pool.pool_run(fb_pool.POOL_IO, fb_sql.db_batch_write, *batch)
+            committed = True
+        except sqlite3.Error as error:
+            sql_logger.error("Unable to commit the database: %s", error)
+        finally:
+            fb_sql.db_commit_finished(committed)
+
+async def bot_main():
+    """ Run the bot until told to shut down """
     # config.bot_active controls whether the bot should shut down all activities and exit
-    # intial_connection puts the bot in the startup login phase
-    # config.active_connection makes the main parser loop active going through server messages
+    # config.active_connection is true while connected and processing messages from the server
 
     config.bot_active = True
+    config.joined_channels = set(bot_cfg.channels)
 
     ### CONNECT TO SQLITE DATABASE ###
     # Connect to sqlite database and store connection information
     db_connection = fb_sql.db_initialize()
     # create a Viewers table if it does not already exist
     fb_sql.db_vt_createtable()
-    # count the rows
-
-    while config.bot_active:
-
-        ### START EXTERNAL CONNECTION ###
-        initialize_irc_connection()
-
-        ### LOOP THROUGH MESSAGES FROM SERVER TO TAKE ACTION ###
-        main_parser_loop()
+    # Build the domain blocklist before the first message needs it
+    fb_blocklist.blocklist_domains()
+    committer = asyncio.ensure_future(database_committer())
+    accrual = asyncio.ensure_future(fb_currency.currency_accrual())
+    sound_player = asyncio.ensure_future(fb_vlc.vlc_player())
+    config_watcher = asyncio.ensure_future(fb_reload.config_watcher())
+    metrics_server = await fb_metrics.metrics_serve()
+
+    ### CONNECT TO TWITCH AND LOOP THROUGH MESSAGES FROM SERVER TO TAKE ACTION ###
+    # Moderator status carries over reconnects until USERSTATE says otherwise
+    await fb_connection.irc_run(process_irc_line)
 
     # Loop broken; time to close things down
-    print(fb_sql.db_vt_show_all())
+    committer.cancel()
+    accrual.cancel()
+    config_watcher.cancel()
+    # Wait for the sound effect player to shut down
+    sound_player.cancel()
+    try:
+        await sound_player
+    except asyncio.CancelledError:
+        pass
+    if metrics_server is not None:
+        metrics_server.close()
+    fb_pool.pool_shutdown()
+    fb_raffle.raffle_persist()
+    if sql_logger.isEnabledFor(logging.DEBUG):
+        sql_logger.debug("Viewers table: %s", fb_sql.db_vt_show_all())
     # TODO give feedback from db - # of rows, change from start?
     fb_sql.db_shutdown(db_connection)
+
+### MAIN ###
+if __name__ == "__main__":
+    fb_log.log_setup()
+    try:
+        asyncio.run(bot_main())
+    finally:
+        fb_log.log_shutdown()
     exit(0)
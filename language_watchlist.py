@@ -2,9 +2,13 @@
 
 # This file is part of the Foundational IRC Bot project.
 
-# Lists are combined at the end of the file. Remember to adjust if adding more lists.
+# The URL lists are read by fb_blocklist.py and prohibited_words by
+# fb_watchlist.py; a new list needs adding where those modules, and
+# fb_reload.py, read them. Edits are picked up while the bot runs.
 
-# List of word strings, comma separted to take action on
+# Web address domains to take action on, comma separated. These are checked by
+# domain (fb_blocklist.py), so subdomains are caught too; larger lists can be
+# loaded from files through bot_cfg.blocklist_files.
 url_shortener_list = [ "bit.do",
             "t.co",
             "lnkd.in",
@@ -49,7 +53,7 @@ url_shortener_list = [ "bit.do",
             "dft.ba",
             "aka.gr",
             "tr.im",
-            "tinyarrows.com"
+            "tinyarrows.com",
             "➡.ws",
             "ieurl.eu",
             "bigly.us",
@@ -60,5 +64,5 @@ url_lengthener_list = [ "megaurl.it",
             "megaurl.co",
             "enlar.gr" ]
 
-#Combined watch list for one loop in the parser
-prohibited_words = url_shortener_list + url_lengthener_list
+# List of word strings, comma separated, to take action on wherever they appear in a message
+prohibited_words = []